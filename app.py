@@ -1,32 +1,212 @@
-from flask import Flask, render_template, redirect, url_for, request, flash
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Flask, render_template, redirect, url_for, request, flash, jsonify, Response, session, g, abort
+from sqlalchemy import update, delete, func
 from extensions import db
 from models import User, Plant
+from migrations import upgrade
 from tree_generator import TreeGenerator
+from tree_cache import TreeCache, CACHE_VERSION
+from atlas import TreeAtlas
+from render_service import RenderService, RenderBusy, render_tree_body
+from passwords import PasswordHasher
+import garden_stats
+import watering_log
+import metrics
+import assets
+from metrics import Counter, Callback, phase
+import json
 import os
 import random
+import time
+
+
+def load_secret_key(path):
+    # Made once and kept in the instance folder, so sessions survive restarts
+    # and every worker process signs with the same key. The key is written
+    # aside and linked into place, so racing workers all end up with one key.
+    try:
+        with open(path, 'rb') as source:
+            return source.read()
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as out:
+        out.write(os.urandom(32))
+    try:
+        os.link(tmp_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.unlink(tmp_path)
+    with open(path, 'rb') as source:
+        return source.read()
+
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = os.urandom(24)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///garden.db'
+# Sessions are signed with this key. SECRET_KEY overrides the one generated
+# into the instance folder.
+app.config['SECRET_KEY'] = (os.environ.get('SECRET_KEY')
+                            or load_secret_key(os.path.join(app.instance_path, 'secret_key')))
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///garden.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['TREE_CACHE_SIZE'] = 1024
+app.config['TREE_CACHE_PATH'] = os.environ.get('TREE_CACHE_PATH',
+                                               os.path.join(app.instance_path, 'tree_cache.db'))
+app.config['TREE_ATLAS_PATH'] = os.environ.get('TREE_ATLAS_PATH',
+                                               os.path.join(app.instance_path, 'tree_atlas.bin'))
+# Tree render processes (0 renders in the request thread), how many renders may
+# be queued, and how long a request waits for a place in the queue before a 503
+app.config['RENDER_WORKERS'] = int(os.environ.get('RENDER_WORKERS', os.cpu_count() or 1))
+app.config['RENDER_MAX_PENDING'] = 64
+app.config['RENDER_QUEUE_TIMEOUT'] = 2.0
+# Werkzeug method string, e.g. 'scrypt:65536:8:1' or 'pbkdf2:sha256:600000'.
+# Stored hashes made with other settings are upgraded on the next login.
+# PASSWORD_HASH_WORKERS=0 hashes in the request thread.
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+# Seconds between rollups of the watering log (0 turns the compactor off), and
+# how long raw events are kept once they're rolled up
+app.config['WATERING_COMPACT_INTERVAL'] = int(os.environ.get('WATERING_COMPACT_INTERVAL', 60))
+app.config['WATERING_EVENT_RETENTION'] = 30 * 24 * 3600
 
 db.init_app(app)
+metrics.init_app(app)
+assets.init_app(app)
 
 with app.app_context():
     db.create_all()
+    upgrade(db.engine)
+
+tree_cache = TreeCache(app.config['TREE_CACHE_PATH'], max_entries=app.config['TREE_CACHE_SIZE'])
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'],
+                                 workers=app.config['PASSWORD_HASH_WORKERS'])
+render_service = RenderService(app.config['RENDER_WORKERS'], app.config['RENDER_MAX_PENDING'],
+                               app.config['RENDER_QUEUE_TIMEOUT'])
+# Worker processes import the main module as __mp_main__ (see worker_pool.py),
+# with `python app.py` that's this one and they mustn't start compactors
+if app.config['WATERING_COMPACT_INTERVAL'] and __name__ != '__mp_main__':
+    watering_log.start_compactor(app, app.config['WATERING_COMPACT_INTERVAL'],
+                                 app.config['WATERING_EVENT_RETENTION'])
+
+TREE_WIDTH = 30
+TREE_HEIGHT = 15
+MAX_TREE_STAGE = 10
+MAX_SEED = 10000
+WATER_STEP = 10
+MAX_WATERINGS_PER_REQUEST = 1000
+LEADERBOARD_SIZE = 20
+MAX_LEADERBOARD_SIZE = 100
+HISTORY_WINDOW = 30 * 24 * 3600
+HISTORY_POINTS = 100
+MAX_HISTORY_POINTS = 1000
+PLANTS_PER_PAGE = 24
+# Bump when profile.html changes, so browsers don't keep an old page
+PROFILE_VERSION = 4
+# Profile cards load their trees in the compact format and draw them with
+# static/trees.js. A tree URL always gives the same tree, so browsers keep it.
+TREE_FORMAT = 'compact'
+TREE_MAX_AGE = 365 * 24 * 3600
+TREE_CLASSES = [color.name if color else None for color in TreeGenerator().palette]
+
+
+def load_tree_atlas(path):
+    # Prerendered trees built by `python atlas.py`, used when it matches the current trees
+    if not os.path.exists(path):
+        return None
+    try:
+        atlas = TreeAtlas(path)
+    except ValueError as error:
+        app.logger.warning('Ignoring tree atlas: %s', error)
+        return None
+    # Trees grown live always come from the python engine
+    expected = (CACHE_VERSION, TREE_WIDTH, TREE_HEIGHT, 'python', TREE_FORMAT)
+    if (atlas.version, atlas.width, atlas.height, atlas.engine, atlas.fmt) != expected:
+        app.logger.warning('Ignoring outdated tree atlas %s', path)
+        atlas.close()
+        return None
+    return atlas
+
+
+tree_atlas = load_tree_atlas(app.config['TREE_ATLAS_PATH'])
+
+tree_renders = Counter('garden_tree_renders_total', 'Trees grown and rendered to HTML')
+tree_atlas_hits = Counter('garden_tree_atlas_hits_total', 'Trees served from the prerendered atlas')
+Callback('garden_tree_cache_hits_total', 'Trees served from the in-memory cache', 'counter',
+         lambda: tree_cache.hits)
+Callback('garden_tree_cache_disk_hits_total', 'Trees served from the on-disk cache', 'counter',
+         lambda: tree_cache.disk_hits)
+Callback('garden_tree_cache_evictions_total', 'Trees dropped from the in-memory cache', 'counter',
+         lambda: tree_cache.evictions)
+Callback('garden_tree_cache_size', 'Trees held in the in-memory cache', 'gauge',
+         lambda: tree_cache.stats()['size'])
+Callback('garden_render_coalesced_total', 'Tree renders that joined one already running', 'counter',
+         lambda: render_service.coalesced)
+Callback('garden_render_rejected_total', 'Tree renders turned away with the queue full', 'counter',
+         lambda: render_service.rejected)
+Callback('garden_render_in_flight', 'Tree renders queued or running', 'gauge',
+         lambda: render_service.stats()['in_flight'])
 
 
 def get_current_user():
-    user_id = request.cookies.get('user_id')
-    if user_id:
-        return User.query.get(int(user_id))
-    return None
+    # Looked up at most once per request
+    if 'current_user' not in g:
+        with phase('auth'):
+            user_id = session.get('user_id')
+            g.current_user = db.session.get(User, user_id) if user_id else None
+    return g.current_user
+
+
+def log_in(user):
+    # The signed session carries what the navbar needs, so it doesn't touch the DB
+    session.clear()
+    session['user_id'] = user.id
+    session['username'] = user.username
+    g.current_user = user
+
+
+def bump_garden_version(user):
+    # Incremented in SQL, so concurrent changes can't lose a bump
+    user.garden_version = User.garden_version + 1
 
 
 @app.context_processor
 def inject_user():
-    return dict(get_current_user=get_current_user)
+    return dict(get_current_user=get_current_user, nav_username=session.get('username'),
+                plant_tree_url=plant_tree_url)
+
+
+def render_tree(seed, stage, fmt):
+    # Rendered by the worker pool, a burst of requests for one tree renders it once
+    body = render_service.call((seed, stage, fmt), render_tree_body, tree_cache.path,
+                               seed, stage, TREE_WIDTH, TREE_HEIGHT, fmt)
+    tree_renders.inc()
+    return body
+
+
+def tree_body(seed, stage):
+    with phase('tree'):
+        if tree_atlas is not None:
+            fragment = tree_atlas.get(seed, stage)
+            if fragment is not None:
+                tree_atlas_hits.inc()
+                return str(fragment, 'utf-8')
+        return tree_cache.get(seed, stage, TREE_WIDTH, TREE_HEIGHT, render_tree, TREE_FORMAT)
+
+
+def plant_tree_url(plant):
+    # Seed and cache version ride along in the query, so a URL never points at
+    # another tree, even when a plant id is reused after a delete
+    return url_for('plant_tree', plant_id=plant.id, stage=plant.tree_stage,
+                   seed=plant.seed, v=CACHE_VERSION)
+
+
+@app.errorhandler(RenderBusy)
+def render_busy(error):
+    app.logger.warning('Tree render rejected: %s', error)
+    response = app.make_response(('Сервер перегружен, попробуйте через несколько секунд', 503))
+    response.headers['Retry-After'] = '2'
+    return response
 
 
 @app.route('/')
@@ -46,7 +226,7 @@ def register():
 
         user = User(
             username=username,
-            password=generate_password_hash(password)
+            password=password_hasher.hash(password)
         )
         db.session.add(user)
         db.session.commit()
@@ -57,15 +237,15 @@ def register():
                 name=f'Дерево {habit}',
                 habit=habit,
                 user_id=user.id,
-                seed=random.randint(1, 10000),
+                seed=random.randint(1, MAX_SEED),
                 tree_stage=1
             )
             db.session.add(plant)
+            garden_stats.plant_added(user.id, habit)
         db.session.commit()
 
-        response = redirect(url_for('profile'))
-        response.set_cookie('user_id', str(user.id))
-        return response
+        log_in(user)
+        return redirect(url_for('profile'))
 
     return render_template('register.html')
 
@@ -77,10 +257,12 @@ def login():
         password = request.form['password']
 
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password, password):
-            response = redirect(url_for('profile'))
-            response.set_cookie('user_id', str(user.id))
-            return response
+        if user and password_hasher.verify(user.password, password):
+            if password_hasher.needs_rehash(user.password):
+                user.password = password_hasher.hash(password)
+                db.session.commit()
+            log_in(user)
+            return redirect(url_for('profile'))
 
         flash('Неверное имя пользователя или пароль', 'error')
 
@@ -89,8 +271,10 @@ def login():
 
 @app.route('/logout')
 def logout():
+    session.clear()
     response = redirect(url_for('index'))
-    response.set_cookie('user_id', '', expires=0)
+    # Drop the unsigned cookie used before sessions
+    response.delete_cookie('user_id')
     return response
 
 
@@ -100,27 +284,129 @@ def profile():
     if not user:
         return redirect(url_for('login'))
 
-    plants = Plant.query.filter_by(user_id=user.id).all()
-    plant_trees = {}
-
-    for plant in plants:
-        tree_gen = TreeGenerator()
-        random.seed(plant.seed)
-        tree_ansi = tree_gen.generate_tree(plant.tree_stage)
-        tree_html = (tree_ansi
-                     .replace('\033[38;2;139;69;19m', '<span class="tree-trunk">')
-                     .replace('\033[38;2;160;82;45m', '<span class="tree-branch">')
-                     .replace('\033[38;2;34;139;34m', '<span class="tree-leaves">')
-                     .replace('\033[0m', '</span>')
-                     .replace('\n', '<br>'))
-        plant_trees[plant.id] = tree_html
+    # The page only changes with the garden, so a browser holding the current
+    # version gets a 304 without any rendering. Pending flash messages still
+    # need a full page. Trees aren't part of the page, every card fetches its
+    # own when it scrolls into view.
+    page = max(request.args.get('page', 1, type=int), 1)
+    etag = f'{user.id}-{user.garden_version}-{page}-{PROFILE_VERSION}-{CACHE_VERSION}'
+    if '_flashes' not in session and request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        plants = (Plant.query.filter_by(user_id=user.id).order_by(Plant.id)
+                  .paginate(page=page, per_page=PLANTS_PER_PAGE, error_out=False))
+        if page > 1 and not plants.items:
+            return redirect(url_for('profile', page=plants.pages or None))
+
+        response = app.make_response(render_template(
+            'profile.html',
+            user=user,
+            plants=plants,
+            tree_classes=TREE_CLASSES
+        ))
+
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/plant/<int:plant_id>/garden')
+def plant_garden(plant_id):
+    user = get_current_user()
+    if not user:
+        return redirect(url_for('login'))
+
+    plant = Plant.query.filter_by(id=plant_id, user_id=user.id).first_or_404()
+    return render_template('garden.html', plant=plant, max_stages=MAX_TREE_STAGE)
+
+
+@app.route('/plant/<int:plant_id>/tree/<int:stage>')
+def plant_tree(plant_id, stage):
+    # The compact tree of a plant at a stage, see plant_tree_url
+    user = get_current_user()
+    if not user:
+        return jsonify(error='unauthorized'), 401
+
+    plant = Plant.query.filter_by(id=plant_id, user_id=user.id).first_or_404()
+    if not 1 <= stage <= MAX_TREE_STAGE or request.args.get('seed', plant.seed, type=int) != plant.seed:
+        abort(404)
+
+    etag = f'{plant.seed}-{stage}-{CACHE_VERSION}'
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(tree_body(plant.seed, stage), mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = TREE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+def sse_event(event, data, event_id=None):
+    lines = [f'event: {event}']
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}")
+    return '\n'.join(lines) + '\n\n'
 
-    return render_template(
-        'profile.html',
-        user=user,
-        plants=plants,
-        plant_trees=plant_trees
-    )
+
+@app.route('/plant/<int:plant_id>/grow')
+def plant_grow_stream(plant_id):
+    user = get_current_user()
+    if not user:
+        return redirect(url_for('login'))
+
+    plant = Plant.query.filter_by(id=plant_id, user_id=user.id).first_or_404()
+    # A reconnecting EventSource sends the last stage it got, resume after it
+    last_stage = request.headers.get('Last-Event-ID', 0, type=int)
+    tree_gen = TreeGenerator(TREE_WIDTH, TREE_HEIGHT, seed=plant.seed)
+    stage = plant.tree_stage
+
+    def events():
+        yield sse_event('init', {
+            'width': TREE_WIDTH,
+            'height': TREE_HEIGHT,
+            'classes': [color.name if color else None for color in tree_gen.palette],
+        })
+        for grown_stage, cells in tree_gen.grow_steps(stage):
+            if grown_stage > last_stage:
+                yield sse_event('stage', {'stage': grown_stage, 'cells': cells}, grown_stage)
+        yield sse_event('done', {'stage': stage})
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def water_plant(user, plant_id, times=1, history=None):
+    # A single UPDATE ... RETURNING does the progress step and the 100% rollover
+    # in SQLite, so concurrent waterings can't overwrite each other
+    total = Plant.progress + WATER_STEP * times
+    gained = total // 100
+    plant = db.session.execute(
+        update(Plant)
+        .where(Plant.id == plant_id, Plant.user_id == user.id)
+        .values(progress=total % 100,
+                level=Plant.level + gained,
+                tree_stage=func.min(Plant.tree_stage + gained, MAX_TREE_STAGE))
+        .returning(Plant.id, Plant.name, Plant.habit, Plant.seed, Plant.level, Plant.progress,
+                   Plant.tree_stage)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if plant is None:
+        return None, 0
+
+    # Progress stays below 100, which pins down how many levels this added.
+    # Cached trees need no invalidation on a stage-up, they are keyed by seed
+    # and stage and the plant simply asks for the new stage.
+    levels_gained = (WATER_STEP * times - plant.progress + 99) // 100
+    garden_stats.plant_watered(user.id, plant.habit, times, levels_gained,
+                               WATER_STEP * times - 100 * levels_gained)
+    if history is not None:
+        history.append({'user_id': user.id, 'plant_id': plant.id, 'ts': int(time.time()),
+                        'waterings': times, 'levels': levels_gained})
+    return plant, levels_gained
 
 
 @app.route('/update/<int:plant_id>', methods=['POST'])
@@ -129,19 +415,82 @@ def update_plant(plant_id):
     if not user:
         return redirect(url_for('login'))
 
-    plant = Plant.query.filter_by(id=plant_id, user_id=user.id).first()
+    history = []
+    plant, levels_gained = water_plant(user, plant_id, history=history)
     if plant:
-        plant.progress += 10
-
-        if plant.progress >= 100:
-            plant.level += 1
-            plant.progress = 0
-            plant.tree_stage = min(plant.tree_stage + 1, 10)
+        if levels_gained:
             flash(f'Ваше растение {plant.name} выросло до уровня {plant.level}!', 'success')
 
+        watering_log.record(history)
+        bump_garden_version(user)
         db.session.commit()
 
-    return redirect(url_for('profile'))
+    return redirect(url_for('profile', page=request.args.get('page', type=int)))
+
+
+@app.route('/api/water', methods=['POST'])
+def water_batch():
+    # Applies a batch of waterings, e.g. queued by an offline client:
+    # {"events": [{"plant_id": 1}, {"plant_id": 2, "count": 3}, ...]}
+    user = get_current_user()
+    if not user:
+        return jsonify(error='unauthorized'), 401
+
+    payload = request.get_json(silent=True)
+    events = payload.get('events') if isinstance(payload, dict) else None
+    if not isinstance(events, list):
+        return jsonify(error='expected {"events": [...]}'), 400
+
+    waterings = {}
+    for event in events:
+        plant_id = event.get('plant_id') if isinstance(event, dict) else None
+        count = event.get('count', 1) if isinstance(event, dict) else None
+        if type(plant_id) is not int or type(count) is not int or count < 1:
+            return jsonify(error='every event needs an integer plant_id and a positive count'), 400
+        waterings[plant_id] = waterings.get(plant_id, 0) + count
+    if sum(waterings.values()) > MAX_WATERINGS_PER_REQUEST:
+        return jsonify(error=f'at most {MAX_WATERINGS_PER_REQUEST} waterings per request'), 400
+
+    plants = []
+    missing = []
+    history = []
+    for plant_id, times in waterings.items():
+        plant, levels_gained = water_plant(user, plant_id, times, history)
+        if plant is None:
+            missing.append(plant_id)
+            continue
+        plants.append({
+            'id': plant.id,
+            'level': plant.level,
+            'progress': plant.progress,
+            'tree_stage': plant.tree_stage,
+            'levels_gained': levels_gained,
+        })
+
+    if plants:
+        watering_log.record(history)
+        bump_garden_version(user)
+    db.session.commit()
+    return jsonify(plants=plants, missing=missing)
+
+
+@app.route('/api/history')
+def watering_history():
+    # Downsampled waterings for a chart: ?plant_id=&start=&end=&points=, times
+    # in Unix seconds, the whole garden when plant_id is left out
+    user = get_current_user()
+    if not user:
+        return jsonify(error='unauthorized'), 401
+
+    end = request.args.get('end', int(time.time()), type=int)
+    start = request.args.get('start', end - HISTORY_WINDOW, type=int)
+    points = min(max(request.args.get('points', HISTORY_POINTS, type=int), 1), MAX_HISTORY_POINTS)
+    plant_id = request.args.get('plant_id', 0, type=int)
+    if start >= end:
+        return jsonify(error='start must be before end'), 400
+
+    resolution, step, series = watering_log.series(user.id, plant_id, start, end, points)
+    return jsonify(resolution=resolution, step=step, points=series)
 
 
 @app.route('/add_habit', methods=['POST'])
@@ -156,10 +505,12 @@ def add_habit():
             name=f'Дерево {habit_name}',
             habit=habit_name,
             user_id=user.id,
-            seed=random.randint(1, 10000),
+            seed=random.randint(1, MAX_SEED),
             tree_stage=1
         )
         db.session.add(plant)
+        garden_stats.plant_added(user.id, habit_name)
+        bump_garden_version(user)
         db.session.commit()
         flash(f'Новая привычка "{habit_name}" добавлена!', 'success')
 
@@ -172,13 +523,56 @@ def delete_plant(plant_id):
     if not user:
         return redirect(url_for('login'))
 
-    plant = Plant.query.filter_by(id=plant_id, user_id=user.id).first()
+    # The totals to take off come from the deleted row itself, so a watering
+    # committed in between can't leave them off
+    plant = db.session.execute(
+        delete(Plant)
+        .where(Plant.id == plant_id, Plant.user_id == user.id)
+        .returning(Plant.habit, Plant.level, Plant.progress)
+        .execution_options(synchronize_session=False)
+    ).first()
     if plant:
-        db.session.delete(plant)
+        garden_stats.plant_removed(user.id, plant.habit, plant.level, plant.progress)
+        bump_garden_version(user)
         db.session.commit()
         flash(f'Привычка "{plant.habit}" удалена', 'success')
 
-    return redirect(url_for('profile'))
+    return redirect(url_for('profile', page=request.args.get('page', type=int)))
+
+
+@app.route('/leaderboard')
+def leaderboard():
+    user = get_current_user()
+    return render_template(
+        'leaderboard.html',
+        leaders=garden_stats.leaderboard(LEADERBOARD_SIZE),
+        habits=garden_stats.top_habits(LEADERBOARD_SIZE),
+        totals=garden_stats.user_totals(user.id) if user else None
+    )
+
+
+@app.route('/api/leaderboard')
+def leaderboard_api():
+    limit = min(max(request.args.get('limit', LEADERBOARD_SIZE, type=int), 1), MAX_LEADERBOARD_SIZE)
+    return jsonify(
+        users=[row._asdict() for row in garden_stats.leaderboard(limit)],
+        habits=[row._asdict() for row in garden_stats.top_habits(limit)]
+    )
+
+
+@app.route('/stats/tree_cache')
+def tree_cache_stats():
+    return jsonify(tree_cache.stats())
+
+
+@app.route('/stats/render')
+def render_stats():
+    return jsonify(render_service.stats())
+
+
+@app.route('/metrics')
+def metrics_page():
+    return Response(metrics.expose(), content_type=metrics.CONTENT_TYPE)
 
 
 if __name__ == '__main__':
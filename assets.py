@@ -0,0 +1,130 @@
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+
+from flask import request, send_from_directory
+
+try:
+    import brotli
+except ImportError:  # optional, without it only gzip variants are built
+    brotli = None
+
+# `python assets.py` copies every file in static/ to static/dist/ under a name
+# with its content hash (style.css -> style.1a2b3c4d5e.css), next to .gz and .br
+# variants, and writes dist/manifest.json. With a manifest in place
+# url_for('static', filename=...) points at the hashed copy, which is served
+# precompressed and cached by browsers for good.
+
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+HASH_LENGTH = 10
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# Already compressed formats gain nothing from another pass
+SKIP_COMPRESSION = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.woff', '.woff2',
+                    '.zip', '.gz', '.br', '.pptx', '.docx', '.xlsx', '.pdf'}
+# Variants in order of preference, as (encoding, suffix)
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def hashed_name(name, data):
+    stem, suffix = os.path.splitext(name)
+    return f'{stem}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{suffix}'
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as out:
+        out.write(data)
+
+
+def build(static_dir):
+    # Older hashed files are kept, pages cached elsewhere may still link them
+    dist_dir = os.path.join(static_dir, DIST)
+    manifest = {}
+    for root, dirs, files in os.walk(static_dir):
+        if root == static_dir and DIST in dirs:
+            dirs.remove(DIST)
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, static_dir).replace(os.sep, '/')
+            with open(path, 'rb') as source:
+                data = source.read()
+            target = hashed_name(name, data)
+            manifest[name] = target
+            out_path = os.path.join(dist_dir, target)
+            write_file(out_path, data)
+
+            if os.path.splitext(name)[1].lower() in SKIP_COMPRESSION:
+                continue
+            # A variant only ships when it's actually smaller
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(compressed) < len(data):
+                write_file(out_path + '.gz', compressed)
+            if brotli is not None:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data):
+                    write_file(out_path + '.br', compressed)
+
+    write_file(os.path.join(dist_dir, MANIFEST),
+               json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+
+def load_manifest(static_dir):
+    try:
+        with open(os.path.join(static_dir, DIST, MANIFEST), encoding='utf-8') as source:
+            return json.load(source)
+    except FileNotFoundError:
+        return {}
+
+
+def init_app(app):
+    # Without a built manifest everything is served from static/ as before
+    static_dir = app.static_folder
+    dist_dir = os.path.join(static_dir, DIST)
+    manifest = load_manifest(static_dir)
+    serve_static = app.view_functions['static']
+
+    @app.url_defaults
+    def hashed_static_url(endpoint, values):
+        if endpoint == 'static':
+            target = manifest.get(values.get('filename'))
+            if target is not None:
+                values['filename'] = f'{DIST}/{target}'
+
+    def static(filename):
+        if not filename.startswith(DIST + '/') or filename == f'{DIST}/{MANIFEST}':
+            return serve_static(filename=filename)
+
+        name = filename[len(DIST) + 1:]
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        for encoding, suffix in ENCODINGS:
+            if request.accept_encodings[encoding] and os.path.isfile(os.path.join(dist_dir, name + suffix)):
+                response = send_from_directory(dist_dir, name + suffix, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(dist_dir, name, mimetype=mimetype)
+        response.headers['Cache-Control'] = IMMUTABLE
+        response.vary.add('Accept-Encoding')
+        return response
+
+    app.view_functions['static'] = static
+    app.extensions['asset_manifest'] = manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fingerprint and precompress static files')
+    parser.add_argument('--static', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+    args = parser.parse_args()
+
+    manifest = build(args.static)
+    print(f"{len(manifest)} files -> {os.path.join(args.static, DIST, MANIFEST)}"
+          f"{'' if brotli is not None else ' (brotli not installed, gzip only)'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import argparse
+import mmap
+import os
+import struct
+import time
+from multiprocessing import Pool
+
+from emitters import emit
+from tree_cache import CACHE_VERSION
+from tree_generator import TreeGenerator
+
+# Layout: header, then an (offset, length) pair per (seed, stage) ordered by
+# seed and then stage, then every tree in the atlas' output format back to back
+MAGIC = b'TREEATLS'
+FORMAT_VERSION = 3
+HEADER = struct.Struct('<8sHHHHIHBB')
+ENTRY = struct.Struct('<II')
+# Stored as an index, the engines grow different trees from the same seed
+ENGINES = ('python', 'numpy')
+FORMATS = ('html', 'compact')
+NUMPY_CHUNK = 512
+
+
+class TreeAtlas:
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        (magic, format_version, self.version, self.width, self.height,
+         self.seeds, self.stages, engine, fmt) = HEADER.unpack_from(self._map)
+        if (magic != MAGIC or format_version != FORMAT_VERSION
+                or engine >= len(ENGINES) or fmt >= len(FORMATS)):
+            self.close()
+            raise ValueError(f"{path} is not a tree atlas this version can read")
+        self.engine = ENGINES[engine]
+        self.fmt = FORMATS[fmt]
+
+    def get(self, seed, stage):
+        # Zero-copy slice of the mapped file, None when the tree isn't in the atlas
+        if not (1 <= seed <= self.seeds and 1 <= stage <= self.stages):
+            return None
+        entry = (seed - 1) * self.stages + stage - 1
+        offset, length = ENTRY.unpack_from(self._map, HEADER.size + entry * ENTRY.size)
+        return self._view[offset:offset + length]
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+        self._file.close()
+
+
+def render_seed(args):
+    # All stages of one seed, each grown on top of the previous one
+    seed, stages, width, height, fmt = args
+    generator = TreeGenerator(width, height, seed=seed)
+    state = generator.start()
+    fragments = []
+    for stage in range(1, stages + 1):
+        generator.grow(stage, state)
+        fragments.append(emit(fmt, state.canvas, generator.palette).encode())
+    return fragments
+
+
+def render_seeds_numpy(args):
+    # All stages of a chunk of seeds grown together, one list of fragments per seed
+    from tree_numpy import BatchGrowth
+    first, last, stages, width, height, fmt = args
+    batch = BatchGrowth(range(first, last), width, height)
+    fragments = [[] for _ in range(first, last)]
+    for stage in range(1, stages + 1):
+        batch.grow_stage()
+        for seed_fragments, body in zip(fragments, batch.render(fmt)):
+            seed_fragments.append(body.encode())
+    return fragments
+
+
+def render_jobs(engine, seeds, stages, width, height, fmt):
+    if engine == 'python':
+        jobs = ((seed, stages, width, height, fmt) for seed in range(1, seeds + 1))
+        return render_seed, jobs, 64
+    jobs = ((first, min(first + NUMPY_CHUNK, seeds + 1), stages, width, height, fmt)
+            for first in range(1, seeds + 1, NUMPY_CHUNK))
+    return render_seeds_numpy, jobs, 1
+
+
+def build_atlas(path, seeds, stages, width=30, height=15, workers=None, engine='python', fmt='compact'):
+    index_size = seeds * stages * ENTRY.size
+    offset = HEADER.size + index_size
+    index = bytearray(index_size)
+    entry = 0
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as out, Pool(workers) as pool:
+        out.write(HEADER.pack(MAGIC, FORMAT_VERSION, CACHE_VERSION, width, height, seeds, stages,
+                              ENGINES.index(engine), FORMATS.index(fmt)))
+        out.write(index)
+
+        render, jobs, chunksize = render_jobs(engine, seeds, stages, width, height, fmt)
+        results = pool.imap(render, jobs, chunksize=chunksize)
+        if engine == 'numpy':
+            results = (fragments for chunk in results for fragments in chunk)
+        for fragments in results:
+            for fragment in fragments:
+                out.write(fragment)
+                ENTRY.pack_into(index, entry * ENTRY.size, offset, len(fragment))
+                offset += len(fragment)
+                entry += 1
+
+        out.seek(HEADER.size)
+        out.write(index)
+    os.replace(tmp_path, path)
+    return offset
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prerender every (seed, stage) tree into an atlas file')
+    parser.add_argument('--output', default=os.path.join('instance', 'tree_atlas.bin'))
+    parser.add_argument('--seeds', type=int, default=10000)
+    parser.add_argument('--stages', type=int, default=10)
+    parser.add_argument('--width', type=int, default=30)
+    parser.add_argument('--height', type=int, default=15)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--engine', choices=ENGINES, default='python',
+                        help="numpy is faster but grows other trees, the app only serves python atlases")
+    parser.add_argument('--format', choices=FORMATS, default='compact',
+                        help="the profile page uses compact trees")
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    start = time.perf_counter()
+    size = build_atlas(args.output, args.seeds, args.stages, args.width, args.height, args.workers,
+                       args.engine, args.format)
+    elapsed = time.perf_counter() - start
+    trees = args.seeds * args.stages
+    print(f"{trees} trees, {size / 1024 / 1024:.1f} MiB in {elapsed:.1f} s "
+          f"({trees / elapsed:.0f} trees/s) -> {args.output}")
+
+
+if __name__ == '__main__':
+    main()
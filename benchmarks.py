@@ -0,0 +1,284 @@
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+
+from sqlalchemy import create_engine, insert, select, text, update, func
+
+import treegenerator
+import treegenrealize
+import tree_numpy
+from extensions import db
+from models import User, Plant
+from tree_generator import TreeGenerator, GrowthState
+
+SUITES = ['engines', 'sqlite', 'flask']
+
+
+def time_each(run, items):
+    samples = []
+    for item in items:
+        start = time.perf_counter()
+        run(item)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def summarize(samples):
+    # Milliseconds, so results of different commits can be compared as they are
+    ordered = sorted(samples)
+    return {
+        'n': len(ordered),
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'p50_ms': ordered[len(ordered) // 2] * 1000,
+        'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+def bench_grow_tree(life_start, multiplier, seeds):
+    def grow(seed):
+        generator = treegenerator.TreeGenerator()
+        generator.conf.seed = seed
+        generator.conf.life_start = life_start
+        generator.conf.multiplier = multiplier
+        generator.init_config()
+        generator.grow_tree()
+
+    # grow_tree prints the finished tree, which is part of what it costs
+    with contextlib.redirect_stdout(io.StringIO()):
+        return summarize(time_each(grow, seeds))
+
+
+def bench_generate_tree_html(seeds):
+    def grow(seed):
+        generator = treegenrealize.TreeGenerator()
+        generator.conf.seed = seed
+        generator.init_config()
+        generator.generate_tree_html()
+
+    return summarize(time_each(grow, seeds))
+
+
+def bench_generate_tree(stage, seeds):
+    return summarize(time_each(lambda seed: TreeGenerator(seed=seed).generate_tree(stage), seeds))
+
+
+def bench_stage_up(stage, seeds):
+    # Growing one stage on top of a stored snapshot of the previous one
+    snapshots = {seed: TreeGenerator(seed=seed).grow(stage - 1).to_bytes() for seed in seeds}
+
+    def grow(seed):
+        generator = TreeGenerator(seed=seed)
+        state = GrowthState.from_bytes(snapshots[seed], generator.new_canvas())
+        generator.grow(stage, state)
+
+    return summarize(time_each(grow, seeds))
+
+
+def bench_numpy_batch(stage, batch, repeats=5):
+    # Per-tree time of growing a whole batch at once
+    samples = time_each(lambda _: tree_numpy.BatchGrowth(range(1, batch + 1)).grow(stage), range(repeats))
+    return summarize([sample / batch for sample in samples])
+
+
+def bench_engines(seeds, life_starts, multipliers, batch):
+    results = {
+        'treegenerator.grow_tree': [
+            {'life_start': life_start, 'multiplier': multiplier,
+             **bench_grow_tree(life_start, multiplier, seeds)}
+            for life_start in life_starts for multiplier in multipliers
+        ],
+        'treegenrealize.generate_tree_html': bench_generate_tree_html(seeds),
+        'tree_generator.generate_tree': {
+            stage: bench_generate_tree(stage, seeds) for stage in range(1, 11)
+        },
+        'tree_generator.stage_up': {
+            stage: bench_stage_up(stage, seeds) for stage in range(2, 11)
+        },
+    }
+    if tree_numpy.np is not None:
+        results['tree_numpy.grow_batch'] = {
+            stage: bench_numpy_batch(stage, batch) for stage in range(1, 11)
+        }
+    return results
+
+
+def build_garden_db(path, users, plants_per_user, password='-'):
+    engine = create_engine(f'sqlite:///{path}')
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [
+            {'id': user_id, 'username': f'user{user_id}', 'password': password}
+            for user_id in range(1, users + 1)
+        ])
+        # Plants are inserted round-robin, so one user's plants are spread over the table
+        conn.execute(insert(Plant), [
+            {'name': f'Дерево {n}', 'habit': str(n), 'level': 1, 'progress': 0,
+             'tree_stage': 1, 'seed': user_id, 'user_id': user_id}
+            for n in range(plants_per_user) for user_id in range(1, users + 1)
+        ])
+    return engine
+
+
+def bench_queries(engine, user_ids):
+    # The statements behind /profile and /update
+    with engine.connect() as conn:
+        plant_ids = {user_id: conn.execute(select(Plant.id).where(Plant.user_id == user_id)).scalars().first()
+                     for user_id in user_ids}
+
+        def profile(user_id):
+            conn.execute(select(Plant).where(Plant.user_id == user_id)).all()
+
+        def water(user_id):
+            total = Plant.progress + 10
+            conn.execute(
+                update(Plant)
+                .where(Plant.id == plant_ids[user_id], Plant.user_id == user_id)
+                .values(progress=total % 100, level=Plant.level + total // 100,
+                        tree_stage=func.min(Plant.tree_stage + total // 100, 10))
+                .returning(Plant.id)
+            ).first()
+            conn.commit()
+
+        return {'profile': summarize(time_each(profile, user_ids)),
+                'water': summarize(time_each(water, user_ids))}
+
+
+def bench_sqlite(users, plants_per_user, user_ids):
+    with tempfile.TemporaryDirectory() as directory:
+        engine = build_garden_db(os.path.join(directory, 'garden.db'), users, plants_per_user)
+        results = {'indexed': bench_queries(engine, user_ids)}
+        with engine.begin() as conn:
+            conn.execute(text('DROP INDEX ix_plant_user_id_id'))
+        results['no_index'] = bench_queries(engine, user_ids)
+        engine.dispose()
+    return results
+
+
+def bench_flask(users, plants_per_user, user_ids):
+    # Whole requests through the test client, against a generated database.
+    # Every user shares one password so only a single hash has to be made.
+    # The tree cache lives in the temporary directory too, without an atlas
+    # (trees are always rendered or cached), and no compactor runs.
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'garden.db')
+        os.environ['DATABASE_URL'] = f'sqlite:///{path}'
+        os.environ['TREE_CACHE_PATH'] = os.path.join(directory, 'tree_cache.db')
+        os.environ['TREE_ATLAS_PATH'] = os.path.join(directory, 'tree_atlas.bin')
+        os.environ['WATERING_COMPACT_INTERVAL'] = '0'
+        garden = importlib.import_module('app')
+        build_garden_db(path, users, plants_per_user, garden.password_hasher.hash('password')).dispose()
+        with garden.app.app_context():
+            plant_ids = {user_id: db.session.execute(
+                select(Plant.id).where(Plant.user_id == user_id)).scalars().first()
+                for user_id in user_ids}
+
+        clients = {}
+
+        def login(user_id):
+            client = garden.app.test_client()
+            client.post('/login', data={'username': f'user{user_id}', 'password': 'password'})
+            clients[user_id] = client
+
+        results = {
+            'login': summarize(time_each(login, user_ids)),
+            'profile': summarize(time_each(lambda user_id: clients[user_id].get('/profile'), user_ids)),
+            'tree': summarize(time_each(
+                lambda user_id: clients[user_id].get(f'/plant/{plant_ids[user_id]}/tree/1'), user_ids)),
+            'update': summarize(time_each(
+                lambda user_id: clients[user_id].post(f'/update/{plant_ids[user_id]}'), user_ids)),
+        }
+        garden.password_hasher.shutdown()
+        garden.render_service.shutdown()
+        with garden.app.app_context():
+            db.engine.dispose()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    def line(name, summary):
+        print(f"{name}: mean {summary['mean_ms']:.3f} ms, p50 {summary['p50_ms']:.3f} ms, "
+              f"p95 {summary['p95_ms']:.3f} ms")
+
+    engines = results.get('engines')
+    if engines:
+        for summary in engines['treegenerator.grow_tree']:
+            line(f"treegenerator.grow_tree life_start={summary['life_start']} "
+                 f"multiplier={summary['multiplier']}", summary)
+        line('treegenrealize.generate_tree_html', engines['treegenrealize.generate_tree_html'])
+        for stage, summary in engines['tree_generator.generate_tree'].items():
+            line(f"tree_generator.generate_tree stage={stage}", summary)
+        for stage, summary in engines['tree_generator.stage_up'].items():
+            line(f"tree_generator stage {stage - 1}->{stage}", summary)
+        for stage, summary in engines.get('tree_numpy.grow_batch', {}).items():
+            line(f"tree_numpy.grow_batch stage={stage} (per tree)", summary)
+    for label, queries in results.get('sqlite', {}).items():
+        for name, summary in queries.items():
+            line(f"sqlite {label} {name}", summary)
+    for name, summary in results.get('flask', {}).items():
+        line(f"flask {name}", summary)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Timings of the growth engines and the garden request paths')
+    parser.add_argument('suites', nargs='*', metavar='suite', help=f"any of {', '.join(SUITES)} (default: all)")
+    parser.add_argument('--seeds', type=int, default=20)
+    parser.add_argument('--life-start', type=int, nargs='+', default=[32, 64, 100])
+    parser.add_argument('--multiplier', type=int, nargs='+', default=[5])
+    parser.add_argument('--batch', type=int, default=1000, help='trees per numpy batch')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--plants-per-user', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=200, help='users sampled per query or request')
+    parser.add_argument('--json', metavar='PATH', help='also write the results to this file')
+    args = parser.parse_args()
+    unknown = set(args.suites) - set(SUITES)
+    if unknown:
+        parser.error(f"unknown suite: {', '.join(sorted(unknown))}")
+    suites = args.suites = args.suites or SUITES
+
+    seeds = range(1, args.seeds + 1)
+    rng = random.Random(0)
+    user_ids = rng.sample(range(1, args.users + 1), min(args.requests, args.users))
+
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'args': vars(args),
+        },
+    }
+    if 'engines' in suites:
+        results['engines'] = bench_engines(seeds, args.life_start, args.multiplier, args.batch)
+    if 'sqlite' in suites:
+        results['sqlite'] = bench_sqlite(args.users, args.plants_per_user, user_ids)
+    if 'flask' in suites:
+        results['flask'] = bench_flask(args.users, args.plants_per_user, user_ids)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+from array import array
+
+
+class Canvas:
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        # Per-cell indices into glyph_table and into the caller's color palette,
+        # 0 meaning an empty cell and no color
+        self.glyphs = array('H', bytes(2 * width * height))
+        self.colors = bytearray(width * height)
+        self.glyph_table = [' ']
+        self._glyph_ids = {' ': 0}
+        # Set of changed cell indices, only kept once a renderer asks for it
+        self.dirty = None
+
+    def glyph_id(self, glyph):
+        glyph_id = self._glyph_ids.get(glyph)
+        if glyph_id is None:
+            glyph_id = len(self.glyph_table)
+            self.glyph_table.append(glyph)
+            self._glyph_ids[glyph] = glyph_id
+        return glyph_id
+
+    def put(self, x, y, glyph, color):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            index = y * self.width + x
+            self.glyphs[index] = self.glyph_id(glyph)
+            self.colors[index] = color
+            if self.dirty is not None:
+                self.dirty.add(index)
+
+    def get(self, x, y):
+        index = y * self.width + x
+        return self.glyph_table[self.glyphs[index]], self.colors[index]
+
+    def row_runs(self, y):
+        # Yields (x, color, text) for the row, merging neighbouring cells of the same color
+        glyphs, colors, table = self.glyphs, self.colors, self.glyph_table
+        start = y * self.width
+        run_start = start
+        run_color = colors[start]
+        run = []
+        for index in range(start, start + self.width):
+            color = colors[index]
+            if color != run_color:
+                yield run_start - start, run_color, ''.join(run)
+                run_start = index
+                run_color = color
+                run = []
+            run.append(table[glyphs[index]])
+        yield run_start - start, run_color, ''.join(run)
@@ -0,0 +1,122 @@
+import json
+from collections import namedtuple
+from html import escape
+
+# A palette is a list indexed by canvas color, entry 0 (empty cell) is None
+Color = namedtuple('Color', ['name', 'ansi', 'rgb'])
+
+ANSI_RESET = '\033[0m'
+
+SVG_CELL_WIDTH = 10
+SVG_CELL_HEIGHT = 18
+
+
+def to_ansi(canvas, palette):
+    rows = []
+    for y in range(canvas.height):
+        row = []
+        for x, color, text in canvas.row_runs(y):
+            if color:
+                row.append(f"{palette[color].ansi}{text}{ANSI_RESET}")
+            else:
+                row.append(text)
+        rows.append(''.join(row))
+    return '\n'.join(rows)
+
+
+def to_html(canvas, palette):
+    rows = []
+    for y in range(canvas.height):
+        row = []
+        for x, color, text in canvas.row_runs(y):
+            if color:
+                row.append(f'<span class="{palette[color].name}">{escape(text)}</span>')
+            else:
+                row.append(text)
+        rows.append(''.join(row))
+    return '<br>'.join(rows)
+
+
+def to_svg(canvas, palette):
+    width = canvas.width * SVG_CELL_WIDTH
+    height = canvas.height * SVG_CELL_HEIGHT
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {width} {height}" '
+        f'width="{width}" height="{height}" font-family="monospace" '
+        f'font-size="{SVG_CELL_HEIGHT - 2}" xml:space="preserve">'
+    ]
+    for y in range(canvas.height):
+        baseline = (y + 1) * SVG_CELL_HEIGHT - 4
+        for x, color, text in canvas.row_runs(y):
+            if color:
+                parts.append(f'<text x="{x * SVG_CELL_WIDTH}" y="{baseline}" '
+                             f'textLength="{len(text) * SVG_CELL_WIDTH}" '
+                             f'fill="{palette[color].rgb}">{escape(text)}</text>')
+    parts.append('</svg>')
+    return ''.join(parts)
+
+
+def to_json(canvas, palette):
+    # Only colored runs are listed, as [x, color, text] per row
+    rows = [[[x, color, text] for x, color, text in canvas.row_runs(y) if color]
+            for y in range(canvas.height)]
+    return json.dumps({
+        'width': canvas.width,
+        'height': canvas.height,
+        'colors': [color.rgb if color else None for color in palette],
+        'rows': rows,
+    }, ensure_ascii=False, separators=(',', ':'))
+
+
+SYMBOL_LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+
+def to_compact(canvas, palette):
+    # {"w", "h", "s": [[glyph, color], ...], "d": cells}. Cells go row by row, a
+    # letter picks an entry of "s" (A = 0, ..., z = 51) and a number skips that
+    # many empty cells. Trailing empty cells are left out. Colors are palette
+    # indices, the page maps them to its classes. '<' is escaped, so the output
+    # can go straight into a <script> block.
+    symbols = {}
+    listed = []
+    parts = []
+    empty = 0
+    glyph_table = canvas.glyph_table
+    for glyph, color in zip(canvas.glyphs, canvas.colors):
+        if not glyph and not color:
+            empty += 1
+            continue
+        key = (glyph, color)
+        letter = symbols.get(key)
+        if letter is None:
+            if len(listed) == len(SYMBOL_LETTERS):
+                raise ValueError("Too many distinct cells for the compact format")
+            letter = symbols[key] = SYMBOL_LETTERS[len(listed)]
+            listed.append([glyph_table[glyph], color])
+        if empty:
+            parts.append(str(empty))
+            empty = 0
+        parts.append(letter)
+    return json.dumps({
+        'w': canvas.width,
+        'h': canvas.height,
+        's': listed,
+        'd': ''.join(parts),
+    }, ensure_ascii=False, separators=(',', ':')).replace('<', '\\u003c')
+
+
+EMITTERS = {
+    'ansi': to_ansi,
+    'html': to_html,
+    'svg': to_svg,
+    'json': to_json,
+    'compact': to_compact,
+}
+
+
+def emit(fmt, canvas, palette):
+    try:
+        emitter = EMITTERS[fmt]
+    except KeyError:
+        raise ValueError(f"Unknown output format: {fmt}") from None
+    return emitter(canvas, palette)
@@ -1,3 +1,26 @@
+import sqlite3
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+db = SQLAlchemy()
+
+# Applied to every new SQLite connection: WAL lets readers run alongside the
+# writer, and with WAL synchronous=NORMAL is still safe against corruption
+SQLITE_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA busy_timeout=5000',
+]
+
 
-db = SQLAlchemy()
\ No newline at end of file
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
@@ -0,0 +1,89 @@
+from sqlalchemy import select, update
+from sqlalchemy.dialects.sqlite import insert
+
+from extensions import db
+from models import User, UserStats, HabitStats
+
+# Summary tables behind the leaderboard and stats. Every plant change also applies
+# its difference here, in the same transaction and as relative updates, so the
+# totals never drift from the plant table and reading them is a top-K index scan.
+
+
+def plant_added(user_id, habit, level=1, progress=0):
+    db.session.execute(
+        insert(UserStats)
+        .values(user_id=user_id, plants=1, total_level=level, total_progress=progress, waterings=0)
+        .on_conflict_do_update(index_elements=['user_id'], set_={
+            'plants': UserStats.plants + 1,
+            'total_level': UserStats.total_level + level,
+            'total_progress': UserStats.total_progress + progress,
+        })
+    )
+    db.session.execute(
+        insert(HabitStats)
+        .values(habit=habit, plants=1, total_level=level, waterings=0)
+        .on_conflict_do_update(index_elements=['habit'], set_={
+            'plants': HabitStats.plants + 1,
+            'total_level': HabitStats.total_level + level,
+        })
+    )
+
+
+def plant_watered(user_id, habit, times, levels_gained, progress_change):
+    db.session.execute(
+        update(UserStats)
+        .where(UserStats.user_id == user_id)
+        .values(total_level=UserStats.total_level + levels_gained,
+                total_progress=UserStats.total_progress + progress_change,
+                waterings=UserStats.waterings + times)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(
+        update(HabitStats)
+        .where(HabitStats.habit == habit)
+        .values(total_level=HabitStats.total_level + levels_gained,
+                waterings=HabitStats.waterings + times)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def plant_removed(user_id, habit, level, progress):
+    # Waterings stay counted, they happened
+    db.session.execute(
+        update(UserStats)
+        .where(UserStats.user_id == user_id)
+        .values(plants=UserStats.plants - 1,
+                total_level=UserStats.total_level - level,
+                total_progress=UserStats.total_progress - progress)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(
+        update(HabitStats)
+        .where(HabitStats.habit == habit)
+        .values(plants=HabitStats.plants - 1,
+                total_level=HabitStats.total_level - level)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def leaderboard(limit=10):
+    return db.session.execute(
+        select(User.username, UserStats.plants, UserStats.total_level,
+               UserStats.total_progress, UserStats.waterings)
+        .join(User, User.id == UserStats.user_id)
+        .order_by(UserStats.total_level.desc(), UserStats.total_progress.desc())
+        .limit(limit)
+    ).all()
+
+
+def top_habits(limit=10):
+    return db.session.execute(
+        select(HabitStats.habit, HabitStats.plants, HabitStats.total_level, HabitStats.waterings)
+        .where(HabitStats.plants > 0)
+        .order_by(HabitStats.plants.desc())
+        .limit(limit)
+    ).all()
+
+
+def user_totals(user_id):
+    return db.session.get(UserStats, user_id)
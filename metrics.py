@@ -0,0 +1,190 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from flask.signals import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Per-request phase timings, sent back in a Server-Timing header, and
+# process-wide counters and histograms served in the Prometheus text format.
+# Recording a value is a dict update under a lock, cheap enough to keep on.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+REGISTRY = []
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f'{self.name}{format_labels(self.labels, labels)} {value}'
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # Per label set: a count per bucket plus one for +Inf, then the sum
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bucket] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, list(counts)) for labels, counts in self._values.items())
+        names = self.labels + ('le',)
+        for labels, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield f'{self.name}_bucket{format_labels(names, labels + (bound,))} {total}'
+            yield f'{self.name}_sum{format_labels(self.labels, labels)} {counts[-1]}'
+            yield f'{self.name}_count{format_labels(self.labels, labels)} {total}'
+
+
+class Callback:
+    # A value owned by someone else (e.g. cache counters), read at scrape time
+    def __init__(self, name, help, kind, read):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.read = read
+        REGISTRY.append(self)
+
+    def samples(self):
+        yield f'{self.name} {self.read()}'
+
+
+def expose():
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_SECONDS = Histogram('garden_request_duration_seconds', 'Time to build a response',
+                            ('endpoint', 'method'))
+REQUEST_DB_QUERIES = Counter('garden_db_queries_total', 'SQL statements run while handling requests',
+                             ('endpoint',))
+QUERY_SECONDS = Histogram('garden_db_query_duration_seconds', 'Time spent in single SQL statements',
+                          buckets=QUERY_BUCKETS)
+
+
+def add_timing(name, seconds):
+    if has_request_context() and 'timings' in g:
+        g.timings[name] = g.timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def phase(name):
+    # Adds the time spent in the block to the request's Server-Timing entry
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(name, time.perf_counter() - start)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the statement's execution context, not the pooled connection,
+    # so a statement that raises leaves nothing behind
+    if context is not None:
+        context.query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, 'query_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    QUERY_SECONDS.observe(elapsed)
+    if has_request_context() and 'timings' in g:
+        g.db_queries += 1
+        g.timings['db'] = g.timings.get('db', 0.0) + elapsed
+
+
+def init_app(app):
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        g.timings = {}
+        g.db_queries = 0
+
+    @app.after_request
+    def record_timings(response):
+        if 'request_start' not in g:
+            return response
+        total = time.perf_counter() - g.request_start
+        endpoint = request.endpoint or 'none'
+        REQUEST_SECONDS.observe(total, endpoint, request.method)
+        REQUEST_DB_QUERIES.inc(endpoint, amount=g.db_queries)
+
+        # Phases can overlap, e.g. the user lookup is also counted under db
+        entries = []
+        for name, seconds in g.timings.items():
+            entry = f'{name};dur={seconds * 1000:.2f}'
+            if name == 'db':
+                entry += f';desc="queries: {g.db_queries}"'
+            entries.append(entry)
+        entries.append(f'total;dur={total * 1000:.2f}')
+        response.headers['Server-Timing'] = ', '.join(entries)
+        return response
+
+    def start_template(sender, template, context, **extra):
+        if 'timings' in g:
+            g.template_start = time.perf_counter()
+
+    def end_template(sender, template, context, **extra):
+        if 'template_start' in g:
+            add_timing('template', time.perf_counter() - g.pop('template_start'))
+
+    before_render_template.connect(start_template, app, weak=False)
+    template_rendered.connect(end_template, app, weak=False)
@@ -0,0 +1,77 @@
+from sqlalchemy import inspect, text
+
+# Schema upgrades for existing databases. db.create_all() only creates missing
+# tables, so every change to an existing table gets a step here. The number of
+# applied steps is kept in SQLite's user_version pragma.
+
+
+def add_garden_version(conn):
+    columns = [column['name'] for column in inspect(conn).get_columns('user')]
+    if 'garden_version' not in columns:
+        conn.execute(text('ALTER TABLE "user" ADD COLUMN garden_version INTEGER NOT NULL DEFAULT 0'))
+
+
+def add_plant_owner_index(conn):
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_plant_user_id_id ON plant (user_id, id)'))
+
+
+def backfill_garden_stats(conn):
+    # The summary tables are new (create_all made them), fill them from the plants.
+    # Every watering adds 10% from level 1, which gives the past waterings.
+    conn.execute(text('DELETE FROM user_stats'))
+    conn.execute(text(
+        'INSERT INTO user_stats (user_id, plants, total_level, total_progress, waterings) '
+        'SELECT user_id, count(*), sum(level), sum(progress), sum(((level - 1) * 100 + progress) / 10) '
+        'FROM plant WHERE user_id IS NOT NULL GROUP BY user_id'
+    ))
+    conn.execute(text('DELETE FROM habit_stats'))
+    conn.execute(text(
+        'INSERT INTO habit_stats (habit, plants, total_level, waterings) '
+        'SELECT habit, count(*), sum(level), sum(((level - 1) * 100 + progress) / 10) '
+        'FROM plant GROUP BY habit'
+    ))
+
+
+def autoincrement_watering_events(conn):
+    # Without AUTOINCREMENT SQLite reuses ids once pruning has emptied the table,
+    # and new events at or below the rollup watermark would never be compacted.
+    # SQLite can't alter a primary key, so the table is rebuilt, and the id
+    # sequence starts above both the rows and the watermark.
+    conn.execute(text('DROP TABLE IF EXISTS watering_event_new'))
+    conn.execute(text(
+        'CREATE TABLE watering_event_new ('
+        'id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, '
+        'user_id INTEGER NOT NULL REFERENCES "user" (id), '
+        'plant_id INTEGER NOT NULL, '
+        'ts INTEGER NOT NULL, '
+        'waterings INTEGER NOT NULL, '
+        'levels INTEGER NOT NULL)'
+    ))
+    conn.execute(text(
+        'INSERT INTO watering_event_new (id, user_id, plant_id, ts, waterings, levels) '
+        'SELECT id, user_id, plant_id, ts, waterings, levels FROM watering_event'
+    ))
+    conn.execute(text('DROP TABLE watering_event'))
+    conn.execute(text('ALTER TABLE watering_event_new RENAME TO watering_event'))
+    conn.execute(text("DELETE FROM sqlite_sequence WHERE name = 'watering_event'"))
+    conn.execute(text(
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'watering_event', max("
+        "(SELECT coalesce(max(id), 0) FROM watering_event), "
+        "(SELECT coalesce(max(last_event_id), 0) FROM rollup_state))"
+    ))
+
+
+MIGRATIONS = [
+    add_garden_version,
+    add_plant_owner_index,
+    backfill_garden_stats,
+    autoincrement_watering_events,
+]
+
+
+def upgrade(engine):
+    with engine.begin() as conn:
+        version = conn.execute(text('PRAGMA user_version')).scalar()
+        for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+            migration(conn)
+            conn.execute(text(f'PRAGMA user_version = {number}'))
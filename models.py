@@ -1,6 +1,9 @@
 from extensions import db
 
 class Plant(db.Model):
+    # Every garden query filters by owner, and most by owner and id
+    __table_args__ = (db.Index('ix_plant_user_id_id', 'user_id', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     habit = db.Column(db.String(100), nullable=False)
@@ -13,5 +16,64 @@ class Plant(db.Model):
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
-    password = db.Column(db.String(120), nullable=False)
-    plants = db.relationship('Plant', backref='user', lazy=True)
\ No newline at end of file
+    # Password hash, scrypt hashes are ~160 characters
+    password = db.Column(db.String(255), nullable=False)
+    # Bumped on every change to the user's plants, used for profile ETags
+    garden_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    plants = db.relationship('Plant', backref='user', lazy=True)
+
+class UserStats(db.Model):
+    # Running totals of a user's plants, kept in step with every plant change
+    __tablename__ = 'user_stats'
+    __table_args__ = (db.Index('ix_user_stats_rank', 'total_level', 'total_progress'),)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    plants = db.Column(db.Integer, nullable=False, default=0)
+    total_level = db.Column(db.Integer, nullable=False, default=0)
+    total_progress = db.Column(db.Integer, nullable=False, default=0)
+    waterings = db.Column(db.Integer, nullable=False, default=0)
+
+class HabitStats(db.Model):
+    # The same totals per habit name, over all users
+    __tablename__ = 'habit_stats'
+    __table_args__ = (db.Index('ix_habit_stats_plants', 'plants'),)
+
+    habit = db.Column(db.String(100), primary_key=True)
+    plants = db.Column(db.Integer, nullable=False, default=0)
+    total_level = db.Column(db.Integer, nullable=False, default=0)
+    waterings = db.Column(db.Integer, nullable=False, default=0)
+
+class WateringEvent(db.Model):
+    # Append-only log of waterings, rolled up into watering_rollup in the background.
+    # The compactor tracks its progress by id, so ids must never be handed out
+    # twice, not even after old events are pruned.
+    __tablename__ = 'watering_event'
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # No foreign key, history outlives deleted plants
+    plant_id = db.Column(db.Integer, nullable=False)
+    # Unix time in seconds
+    ts = db.Column(db.Integer, nullable=False)
+    waterings = db.Column(db.Integer, nullable=False)
+    levels = db.Column(db.Integer, nullable=False)
+
+class WateringRollup(db.Model):
+    # Waterings per hour or per day (resolution in seconds) of a plant, or of all
+    # of a user's plants when plant_id is 0
+    __tablename__ = 'watering_rollup'
+
+    user_id = db.Column(db.Integer, primary_key=True)
+    plant_id = db.Column(db.Integer, primary_key=True)
+    resolution = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(db.Integer, primary_key=True)
+    waterings = db.Column(db.Integer, nullable=False)
+    levels = db.Column(db.Integer, nullable=False)
+
+class RollupState(db.Model):
+    # Last watering_event id already added to the rollups
+    __tablename__ = 'rollup_state'
+
+    name = db.Column(db.String(40), primary_key=True)
+    last_event_id = db.Column(db.Integer, nullable=False)
@@ -0,0 +1,28 @@
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from worker_pool import WorkerPool
+
+
+class PasswordHasher:
+    # Hashing is pure CPU and holds the GIL, so it runs in worker processes
+    # while the request thread only waits on the result. workers=0 hashes in
+    # the calling thread.
+    def __init__(self, method='scrypt', workers=None):
+        self.method = method
+        self.workers = workers
+        # Werkzeug fills in default parameters ('scrypt' -> 'scrypt:32768:8:1'),
+        # hash once to learn the prefix new hashes get under this method
+        self.prefix = generate_password_hash('', method).split('$', 1)[0]
+        self._pool = WorkerPool(workers)
+
+    def hash(self, password):
+        return self._pool.run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._pool.run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return pwhash.split('$', 1)[0] != self.prefix
+
+    def shutdown(self):
+        self._pool.shutdown()
@@ -0,0 +1,97 @@
+import threading
+from concurrent.futures import Future
+
+from emitters import emit
+from tree_cache import TreeCache
+from tree_generator import TreeGenerator, GrowthState
+from worker_pool import WorkerPool
+
+# Tree renders run in a pool of worker processes, so rendering uses every core
+# and web threads only wait on a result. Identical renders in flight at the same
+# time are done once (singleflight), and when too many are queued new ones are
+# turned away instead of piling up.
+
+
+class RenderBusy(Exception):
+    pass
+
+
+# One cache per worker process, for the growth snapshots
+_caches = {}
+
+
+def render_tree_body(cache_path, seed, stage, width, height, fmt='html'):
+    # Continue from the latest stored growth stage instead of growing from scratch
+    cache = _caches.get(cache_path)
+    if cache is None:
+        cache = _caches[cache_path] = TreeCache(cache_path)
+    tree_gen = TreeGenerator(width, height, seed=seed)
+    snapshot = cache.load_growth(seed, stage, width, height)
+    state = GrowthState.from_bytes(snapshot, tree_gen.new_canvas()) if snapshot else None
+    if state is None or state.stage < stage:
+        state = tree_gen.grow(stage, state)
+        cache.save_growth(seed, stage, width, height, state.to_bytes())
+    return emit(fmt, state.canvas, tree_gen.palette)
+
+
+class RenderService:
+    def __init__(self, workers=None, max_pending=64, queue_timeout=1.0):
+        # workers=0 renders in the calling thread, still with singleflight
+        self.workers = workers
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self.renders = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self._flights = {}
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pool = WorkerPool(workers)
+
+    def call(self, key, fn, *args):
+        # fn(*args) in a worker process, calls with the same key that overlap
+        # share one run and its result (or error)
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return flight.result()
+
+        try:
+            if not self._slots.acquire(timeout=self.queue_timeout):
+                with self._lock:
+                    self.rejected += 1
+                raise RenderBusy(f"{self.max_pending} renders already pending")
+            try:
+                result = self._pool.run(fn, *args)
+            finally:
+                self._slots.release()
+        except BaseException as error:
+            flight.set_exception(error)
+            raise
+        else:
+            flight.set_result(result)
+            with self._lock:
+                self.renders += 1
+            return result
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'in_flight': len(self._flights),
+                'renders': self.renders,
+                'coalesced': self.coalesced,
+                'rejected': self.rejected,
+            }
+
+    def shutdown(self):
+        self._pool.shutdown()
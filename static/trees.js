@@ -0,0 +1,100 @@
+(function () {
+    // Draws the trees of the page from their compact form (see to_compact in
+    // emitters.py): "d" lists the cells row by row, a letter picks an entry of
+    // "s" and a number skips that many empty cells.
+    var LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz';
+
+    function decodeCells(tree) {
+        var cells = new Array(tree.w * tree.h);
+        var position = 0;
+        var skip = 0;
+        for (var i = 0; i < tree.d.length; i++) {
+            var code = tree.d.charCodeAt(i);
+            if (code >= 48 && code <= 57) {
+                skip = skip * 10 + code - 48;
+                continue;
+            }
+            position += skip;
+            skip = 0;
+            cells[position++] = tree.s[LETTERS.indexOf(tree.d[i])];
+        }
+        return cells;
+    }
+
+    function appendRun(target, text, className) {
+        if (className) {
+            var span = document.createElement('span');
+            span.className = className;
+            span.textContent = text;
+            target.appendChild(span);
+        } else {
+            target.appendChild(document.createTextNode(text));
+        }
+    }
+
+    // Neighbouring cells of one color share a span, like the server-side HTML
+    function drawTree(tree, classes) {
+        var cells = decodeCells(tree);
+        var fragment = document.createDocumentFragment();
+        for (var y = 0; y < tree.h; y++) {
+            if (y) {
+                fragment.appendChild(document.createElement('br'));
+            }
+            var text = '';
+            var color = null;
+            for (var x = 0; x < tree.w; x++) {
+                var cell = cells[y * tree.w + x];
+                var cellColor = cell ? cell[1] : 0;
+                if (cellColor !== color && text) {
+                    appendRun(fragment, text, classes[color]);
+                    text = '';
+                }
+                color = cellColor;
+                text += cell ? cell[0] : ' ';
+            }
+            appendRun(fragment, text, classes[color]);
+        }
+        return fragment;
+    }
+
+    function loadTree(element, classes) {
+        fetch(element.getAttribute('data-src'), {credentials: 'same-origin'})
+            .then(function (response) {
+                if (!response.ok) {
+                    throw new Error(response.status);
+                }
+                return response.json();
+            })
+            .then(function (tree) {
+                element.appendChild(drawTree(tree, classes));
+            })
+            .catch(function () {
+                element.textContent = 'Не удалось загрузить дерево';
+            });
+    }
+
+    // Trees are fetched as their cards come near the screen
+    var grid = document.querySelector('[data-tree-classes]');
+    if (!grid) {
+        return;
+    }
+    var classes = JSON.parse(grid.getAttribute('data-tree-classes'));
+    var elements = grid.querySelectorAll('.tree[data-src]');
+    if (!('IntersectionObserver' in window)) {
+        for (var i = 0; i < elements.length; i++) {
+            loadTree(elements[i], classes);
+        }
+        return;
+    }
+    var observer = new IntersectionObserver(function (entries) {
+        entries.forEach(function (entry) {
+            if (entry.isIntersecting) {
+                observer.unobserve(entry.target);
+                loadTree(entry.target, classes);
+            }
+        });
+    }, {rootMargin: '200px'});
+    for (var j = 0; j < elements.length; j++) {
+        observer.observe(elements[j]);
+    }
+})();
@@ -0,0 +1,183 @@
+import argparse
+import re
+import sys
+import time
+from array import array
+
+from emitters import ANSI_RESET
+
+ESCAPE = re.compile(r"\033\[([0-9;]*)([A-Za-z])")
+
+
+class LiveRenderer:
+    # Redraws a growing canvas on the terminal, writing only the cells that
+    # changed since the last frame, one buffered write per frame
+    def __init__(self, palette, frame_time, out=None):
+        self.palette = palette
+        self.frame_time = frame_time
+        self.out = out or sys.stdout
+        self.frames = 0
+        self.dropped = 0
+        self._canvas = None
+        self._glyphs = None
+        self._colors = None
+        self._due = None
+
+    def frame(self, canvas):
+        # Called once per growth step. Keeps the animation on a frame_time
+        # schedule and skips drawing while it is behind that schedule.
+        now = time.monotonic()
+        if self._due is None:
+            self._due = now
+        self._due += self.frame_time
+
+        if 0 < self.frame_time and self._due < now and canvas is self._canvas:
+            self.dropped += 1
+            return
+        self.draw(canvas)
+
+        delay = self._due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def draw(self, canvas):
+        if canvas is not self._canvas:
+            # New canvas: clear the screen and draw every cell once
+            self._canvas = canvas
+            self._glyphs = array('H', bytes(len(canvas.glyphs) * 2))
+            self._colors = bytearray(len(canvas.colors))
+            canvas.dirty = {index for index, glyph in enumerate(canvas.glyphs) if glyph}
+            parts = ["\033[2J"] + self._changes(canvas)
+        else:
+            parts = self._changes(canvas)
+
+        canvas.dirty = set()
+        if parts:
+            self.out.write(''.join(parts))
+            self.out.flush()
+        self.frames += 1
+
+    def _changes(self, canvas):
+        # _glyphs/_colors mirror what is on the screen. Rows are laid out like
+        # to_ansi: a cell takes as many columns as its glyph has characters, so
+        # a wide glyph shifts the rest of its row. A changed row is redrawn from
+        # its first changed cell to its last one, or to the end of the row
+        # (clearing what's left) when the changed cells got wider or narrower.
+        glyphs, colors, table = canvas.glyphs, canvas.colors, canvas.glyph_table
+        old_glyphs, old_colors = self._glyphs, self._colors
+        width = canvas.width
+        spans = {}
+        for index in canvas.dirty:
+            if glyphs[index] != old_glyphs[index] or colors[index] != old_colors[index]:
+                y = index // width
+                first, last = spans.get(y, (index, index))
+                spans[y] = (min(first, index), max(last, index))
+
+        parts = []
+        for y in sorted(spans):
+            first, last = spans[y]
+            row_start = y * width
+            resized = (sum(len(table[glyphs[index]]) for index in range(first, last + 1))
+                       != sum(len(table[old_glyphs[index]]) for index in range(first, last + 1)))
+            if resized:
+                last = row_start + width - 1
+            # Cursor addressing is 1-based
+            column = sum(len(table[old_glyphs[index]]) for index in range(row_start, first))
+            parts.append(f"\033[{y + 1};{column + 1}H")
+
+            run_color = colors[first]
+            run = []
+            for index in range(first, last + 1):
+                color = colors[index]
+                if color != run_color:
+                    parts.append(self._run(run_color, run))
+                    run_color = color
+                    run = []
+                run.append(table[glyphs[index]])
+            parts.append(self._run(run_color, run))
+            if resized:
+                parts.append("\033[K")
+
+            old_glyphs[first:last + 1] = glyphs[first:last + 1]
+            old_colors[first:last + 1] = colors[first:last + 1]
+        return parts
+
+    def _run(self, color, run):
+        text = ''.join(run)
+        return f"{self.palette[color].ansi}{text}{ANSI_RESET}" if color else text
+
+    def finish(self, canvas):
+        # Draw whatever frames were dropped and leave the cursor below the tree
+        self.draw(canvas)
+        self.out.write(f"\033[{canvas.height + 1};1H")
+        self.out.flush()
+
+
+def replay(stream):
+    # The screen left by a stream of the escapes LiveRenderer and to_ansi use,
+    # as {(row, column): (char, sgr)} without blank uncolored cells
+    screen = {}
+    y = x = 0
+    sgr = ''
+    position = 0
+    while position < len(stream):
+        match = ESCAPE.match(stream, position)
+        if match:
+            params, command = match.groups()
+            if command == 'J':
+                screen.clear()
+            elif command == 'H':
+                row, column = params.split(';')
+                y, x = int(row) - 1, int(column) - 1
+            elif command == 'K':
+                for key in [key for key in screen if key[0] == y and key[1] >= x]:
+                    del screen[key]
+            elif command == 'm':
+                sgr = '' if params in ('', '0') else params
+            position = match.end()
+            continue
+        char = stream[position]
+        if char == '\n':
+            y, x = y + 1, 0
+        else:
+            if char == ' ' and not sgr:
+                screen.pop((y, x), None)
+            else:
+                screen[(y, x)] = (char, sgr)
+            x += 1
+        position += 1
+    return screen
+
+
+def main():
+    # Grows treegenerator trees live into a buffer and checks that the final
+    # screen is the one print_tree shows for the same seed
+    import contextlib
+    import io
+    import treegenerator
+
+    parser = argparse.ArgumentParser(description="Check live rendering against render('ansi')")
+    parser.add_argument('--seeds', type=int, default=50)
+    parser.add_argument('--frame-time', type=float, default=0.0)
+    args = parser.parse_args()
+
+    mismatched = []
+    for seed in range(1, args.seeds + 1):
+        generator = treegenerator.TreeGenerator()
+        generator.conf.seed = seed
+        generator.conf.leaves = ["@", "#", "*", "%", "&"]
+        generator.init_config()
+        generator.conf.live = True
+        generator.conf.time_step = args.frame_time
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            generator.grow_tree()
+        if replay(out.getvalue()) != replay(generator.render('ansi')):
+            mismatched.append(seed)
+    print(f"{args.seeds - len(mismatched)}/{args.seeds} seeds match"
+          + (f", mismatched: {mismatched}" if mismatched else ''))
+    sys.exit(1 if mismatched else 0)
+
+
+if __name__ == '__main__':
+    main()
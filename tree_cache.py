@@ -0,0 +1,122 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Bump when the tree model or an output format changes, so stale rows on disk are ignored
+CACHE_VERSION = 4
+
+
+class TreeCache:
+    def __init__(self, path, max_entries=512):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            # Rendered trees used to be HTML only
+            conn.execute('DROP TABLE IF EXISTS tree_html')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS tree_render ('
+                'seed INTEGER NOT NULL, stage INTEGER NOT NULL, '
+                'width INTEGER NOT NULL, height INTEGER NOT NULL, fmt TEXT NOT NULL, '
+                'version INTEGER NOT NULL, body TEXT NOT NULL, '
+                'PRIMARY KEY (seed, stage, width, height, fmt, version))'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS tree_growth ('
+                'seed INTEGER NOT NULL, stage INTEGER NOT NULL, '
+                'width INTEGER NOT NULL, height INTEGER NOT NULL, '
+                'version INTEGER NOT NULL, state BLOB NOT NULL, '
+                'PRIMARY KEY (seed, width, height, version, stage))'
+            )
+
+    def _connect(self):
+        # sqlite3 connections can't be shared between threads, keep one per thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, seed, stage, width, height, render, fmt='html'):
+        # render(seed, stage, fmt) makes the tree when it isn't cached yet
+        key = (seed, stage, width, height, fmt)
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return body
+
+        conn = self._connect()
+        row = conn.execute(
+            'SELECT body FROM tree_render '
+            'WHERE seed = ? AND stage = ? AND width = ? AND height = ? AND fmt = ? AND version = ?',
+            (*key, CACHE_VERSION)
+        ).fetchone()
+        if row is not None:
+            body = row[0]
+            with self._lock:
+                self.disk_hits += 1
+                self._remember(key, body)
+            return body
+
+        body = render(seed, stage, fmt)
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO tree_render VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (*key, CACHE_VERSION, body)
+            )
+        with self._lock:
+            self.misses += 1
+            self._remember(key, body)
+        return body
+
+    def _remember(self, key, body):
+        self._entries[key] = body
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def load_growth(self, seed, stage, width, height):
+        # Latest growth snapshot of the tree at or below the given stage
+        row = self._connect().execute(
+            'SELECT state FROM tree_growth '
+            'WHERE seed = ? AND width = ? AND height = ? AND version = ? AND stage <= ? '
+            'ORDER BY stage DESC LIMIT 1',
+            (seed, width, height, CACHE_VERSION, stage)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def save_growth(self, seed, stage, width, height, state):
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO tree_growth VALUES (?, ?, ?, ?, ?, ?)',
+                (seed, stage, width, height, CACHE_VERSION, state)
+            )
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
@@ -1,53 +1,246 @@
 import random
+import struct
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+
+from canvas import Canvas
+from emitters import Color, emit
+
+CHAR_TYPES = ('trunk', 'branch', 'leaves')
+
+# Every tree starts from one trunk cell with this much life. A stage reveals
+# FIRST_STAGE_ROWS rows, and every further stage one more row on top.
+ROOT_LIFE = 20
+FIRST_STAGE_ROWS = 5
+STAGE_ROWS = 1
+
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('<BHHHhHH')
+
+
+class GrowthState:
+    # Everything needed to grow a tree further: the canvas so far, the tips
+    # waiting to be placed in the next row, and the "buds" (cells of the last
+    # grown row that are temporarily drawn as leaves)
+    def __init__(self, canvas, stage=0, row=None, frontier=None, buds=None):
+        self.canvas = canvas
+        self.stage = stage
+        # Row the frontier tips will be placed in
+        self.row = canvas.height - 1 if row is None else row
+        # x -> life of the tips of the next row
+        self.frontier = frontier if frontier is not None else {}
+        # (x, glyph, color) of the true cells hidden under the buds, on row + 1
+        self.buds = buds if buds is not None else []
+
+    def to_bytes(self):
+        canvas = self.canvas
+        header = _SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION, canvas.width, canvas.height,
+                                       self.stage, self.row, len(self.frontier), len(self.buds))
+        tips = array('H')
+        for x, life in self.frontier.items():
+            tips.extend((x, life))
+        buds = array('H')
+        for bud in self.buds:
+            buds.extend(bud)
+        return zlib.compress(header + tips.tobytes() + buds.tobytes()
+                             + canvas.glyphs.tobytes() + bytes(canvas.colors))
+
+    @classmethod
+    def from_bytes(cls, data, canvas):
+        # canvas must be a fresh canvas from the generator the snapshot was made by
+        data = zlib.decompress(data)
+        version, width, height, stage, row, tip_count, bud_count = _SNAPSHOT_HEADER.unpack_from(data)
+        if version != SNAPSHOT_VERSION or (width, height) != (canvas.width, canvas.height):
+            raise ValueError("Growth snapshot doesn't match this generator")
+
+        offset = _SNAPSHOT_HEADER.size
+        tips = array('H', data[offset:offset + 4 * tip_count])
+        offset += 4 * tip_count
+        buds = array('H', data[offset:offset + 6 * bud_count])
+        offset += 6 * bud_count
+        canvas.glyphs = array('H', data[offset:offset + 2 * width * height])
+        offset += 2 * width * height
+        canvas.colors = bytearray(data[offset:offset + width * height])
+
+        frontier = dict(zip(tips[::2], tips[1::2]))
+        buds = [tuple(buds[i:i + 3]) for i in range(0, len(buds), 3)]
+        return cls(canvas, stage, row, frontier, buds)
+
 
 class TreeGenerator:
-    def __init__(self, width=30, height=15):
+    def __init__(self, width=30, height=15, seed=None):
         self.width = width
         self.height = height
-        self.colors = {
-            'trunk': '\033[38;2;139;69;19m',
-            'branch': '\033[38;2;160;82;45m',
-            'leaves': '\033[38;2;34;139;34m',
-            'reset': '\033[0m'
-        }
+        # Each stage draws from its own RNG derived from the seed, so stage N+1
+        # can be grown from a stored stage N without replaying the earlier draws
+        self.seed = seed if seed is not None else random.getrandbits(32)
         self.chars = {
             'trunk': ['║', '│', '┃'],
             'branch': ['╱', '╲', '/', '\\'],
             'leaves': ["@", "#", "*", "%", "&"]
         }
+        # Canvas color index -> Color, index 0 is an empty cell
+        self.palette = [
+            None,
+            Color('tree-trunk', '\033[38;2;139;69;19m', '#8B4513'),
+            Color('tree-branch', '\033[38;2;160;82;45m', '#A0522D'),
+            Color('tree-leaves', '\033[38;2;34;139;34m', '#228B22'),
+        ]
+
+    def new_canvas(self):
+        # Glyphs are registered up front so their ids are the same on every canvas
+        canvas = Canvas(self.width, self.height)
+        for char_type in CHAR_TYPES:
+            for char in self.chars[char_type]:
+                canvas.glyph_id(char)
+        return canvas
+
+    def start(self):
+        state = GrowthState(self.new_canvas())
+        state.frontier = {self.width // 2: ROOT_LIFE}
+        return state
+
+    def grow(self, stage, state=None):
+        if state is None:
+            state = self.start()
+        while state.stage < stage:
+            self.grow_stage(state)
+        return state
 
-    def generate_tree(self, stage):
-        life = min(5 + stage * 2, 20)
-        grid = {}
-        self._grow_branch(grid, self.height - 1, self.width // 2, life)
-        return self._format_tree(grid)
+    def grow_steps(self, stage, state=None):
+        # Grows like grow() but yields (stage, cells) after every stage, cells
+        # being the (x, y, glyph, color) that stage changed, bottom row first
+        if state is None:
+            state = self.start()
+        canvas = state.canvas
+        while state.stage < stage:
+            before_glyphs, before_colors = canvas.glyphs[:], canvas.colors[:]
+            self.grow_stage(state)
+            glyphs, colors, width = canvas.glyphs, canvas.colors, canvas.width
+            changed = [index for index in range(len(glyphs) - 1, -1, -1)
+                       if glyphs[index] != before_glyphs[index] or colors[index] != before_colors[index]]
+            yield state.stage, [(index % width, index // width, canvas.glyph_table[glyphs[index]], colors[index])
+                                for index in changed]
 
-    def _grow_branch(self, grid, y, x, life):
-        if life <= 0 or x < 1 or x >= self.width - 1 or y < 1:
+    def generate_tree(self, stage, fmt='ansi'):
+        return emit(fmt, self.grow(stage).canvas, self.palette)
+
+    def grow_stage(self, state):
+        # Grows the tree by one stage in place, touching only the new rows and the buds
+        state.stage += 1
+        if not state.frontier or state.row < 1:
             return
 
-        if life > 7:
-            char_type = 'trunk'
-        elif life > 3:
-            char_type = 'branch'
-        else:
-            char_type = 'leaves'
-
-        color = self.colors[char_type]
-        grid[(x, y)] = f"{color}{random.choice(self.chars[char_type])}{self.colors['reset']}"
-
-        if life > 2:
-            self._grow_branch(grid, y - 1, x, life - 1)
-            if random.random() > 0.6:
-                self._grow_branch(grid, y - 1, x - 1, life - 3)
-            if random.random() > 0.6:
-                self._grow_branch(grid, y - 1, x + 1, life - 3)
-
-    def _format_tree(self, grid):
-        tree_rows = []
-        for y in range(self.height):
-            row = []
-            for x in range(self.width):
-                row.append(grid.get((x, y), ' '))
-            tree_rows.append(''.join(row))
-        return '\n'.join(tree_rows)
\ No newline at end of file
+        rng = random.Random(f"{self.seed}:{state.stage}")
+        rand = rng.random
+        choice = rng.choice
+        canvas = state.canvas
+        glyphs, colors, width = canvas.glyphs, canvas.colors, canvas.width
+        styles = [
+            (color, [canvas.glyph_id(char) for char in self.chars[char_type]])
+            for color, char_type in enumerate(CHAR_TYPES, 1)
+        ]
+        trunk, branch, leaves = styles
+        right = self.width - 1
+
+        # The last row of the previous stage keeps growing, show its true cells again
+        for x, glyph, color in state.buds:
+            index = (state.row + 1) * width + x
+            glyphs[index] = glyph
+            colors[index] = color
+        state.buds = []
+
+        rows = FIRST_STAGE_ROWS if state.stage == 1 else STAGE_ROWS
+        placed = []
+        for _ in range(rows):
+            if not state.frontier or state.row < 1:
+                break
+
+            # A cell grows straight up, and with some luck also up-left and up-right.
+            # Tips landing on the same cell merge and keep the larger life.
+            next_frontier = {}
+            placed = []
+            for x in sorted(state.frontier):
+                life = state.frontier[x]
+                if life > 7:
+                    color, chars = trunk
+                elif life > 3:
+                    color, chars = branch
+                else:
+                    color, chars = leaves
+
+                index = state.row * width + x
+                glyphs[index] = choice(chars)
+                colors[index] = color
+
+                if life <= 2:
+                    continue
+                placed.append(x)
+                children = [(x, life - 1)]
+                if rand() > 0.6:
+                    children.append((x - 1, life - 3))
+                if rand() > 0.6:
+                    children.append((x + 1, life - 3))
+                for child_x, child_life in children:
+                    if child_life > 0 and 1 <= child_x < right:
+                        next_frontier[child_x] = max(next_frontier.get(child_x, 0), child_life)
+
+            state.frontier = next_frontier
+            state.row -= 1
+
+        # Cells that are still growing are drawn as leaf buds until the next stage
+        if state.frontier:
+            leaf_color, leaf_chars = leaves
+            for x in placed:
+                index = (state.row + 1) * width + x
+                state.buds.append((x, glyphs[index], colors[index]))
+                glyphs[index] = choice(leaf_chars)
+                colors[index] = leaf_color
+
+def render_tree(seed, stage, width=30, height=15, fmt='ansi'):
+    return TreeGenerator(width, height, seed=seed).generate_tree(stage, fmt)
+
+
+def render_chunk(seeds, stage, width=30, height=15, fmt='ansi'):
+    # numpy engine: one batch of seeds, all at the same stage
+    from tree_numpy import render_batch
+    return render_batch(seeds, stage, width, height, fmt)
+
+
+def render_many(trees, width=30, height=15, fmt='ansi', executor='thread', max_workers=None,
+                engine='python', chunk_size=1024):
+    # engine='numpy' grows trees of the same stage together, see tree_numpy for
+    # how its trees relate to their seeds
+    if executor == 'thread':
+        pool_class = ThreadPoolExecutor
+    elif executor == 'process':
+        pool_class = ProcessPoolExecutor
+    else:
+        raise ValueError(f"Unknown executor: {executor}")
+
+    if engine == 'python':
+        seeds = [seed for seed, _ in trees]
+        stages = [stage for _, stage in trees]
+        render = partial(render_tree, width=width, height=height, fmt=fmt)
+        with pool_class(max_workers=max_workers) as pool:
+            return list(pool.map(render, seeds, stages))
+    if engine != 'numpy':
+        raise ValueError(f"Unknown engine: {engine}")
+
+    by_stage = {}
+    for position, (seed, stage) in enumerate(trees):
+        by_stage.setdefault(stage, []).append((position, seed))
+    chunks = [(stage, members[start:start + chunk_size])
+              for stage, members in by_stage.items()
+              for start in range(0, len(members), chunk_size)]
+    render = partial(render_chunk, width=width, height=height, fmt=fmt)
+    results = [None] * len(trees)
+    with pool_class(max_workers=max_workers) as pool:
+        rendered = pool.map(render, [[seed for _, seed in members] for _, members in chunks],
+                            [stage for stage, _ in chunks])
+        for (_, members), outputs in zip(chunks, rendered):
+            for (position, _), output in zip(members, outputs):
+                results[position] = output
+    return results
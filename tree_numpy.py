@@ -0,0 +1,154 @@
+from array import array
+
+try:
+    import numpy as np
+except ImportError:  # optional, only the batch engine needs it
+    np = None
+
+from emitters import emit
+from tree_generator import TreeGenerator, ROOT_LIFE, FIRST_STAGE_ROWS, STAGE_ROWS
+
+# Batch engine for the tree_generator growth model: a whole batch of trees grows
+# one row at a time with array operations over a (trees, width) frontier of
+# lives, into integer glyph and color canvases.
+#
+# The rules are those of TreeGenerator.grow_stage, only the random numbers come
+# from elsewhere, so a seed gives a different (but equally fixed) tree than with
+# the pure-Python engine. Rather than one RNG per tree, every draw is a hash of
+# where it is used, so a whole batch is drawn in one go. For seed n (below
+# 2**32), stage s, the r-th row grown in that stage, plane k and column x:
+#
+#     u = splitmix64(n << 30 | s << 22 | r << 14 | k << 12 | x) >> 11 / 2**53
+#
+# with splitmix64 the finalizer from Java's SplittableRandom (gamma added first).
+# For the tip in column x:
+#   k = 0  picks its glyph, chars[int(u * len(chars))]
+#   k = 1  grows a child up-left when u > 0.6
+#   k = 2  grows a child up-right when u > 0.6
+#   k = 3  picks its leaf glyph while it's shown as a bud
+# FIRST_STAGE_ROWS rows are grown in stage 1 and STAGE_ROWS in every later one.
+# As in the Python engine, stage s + 1 only adds to stage s.
+
+MAX_SEED = 2 ** 32
+
+
+def require_numpy():
+    if np is None:
+        raise RuntimeError("The numpy tree engine needs numpy installed")
+
+
+def splitmix64(z):
+    z = z + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def stage_draws(seeds, stage, width):
+    # Uniform draws of one stage as a (rows, trees, 4, width) array
+    if stage >= 256:
+        raise ValueError("numpy engine stages must be below 256")
+    rows = FIRST_STAGE_ROWS if stage == 1 else STAGE_ROWS
+    counters = ((seeds.astype(np.uint64)[None, :, None, None] << np.uint64(30))
+                | np.uint64(stage << 22)
+                | (np.arange(rows, dtype=np.uint64)[:, None, None, None] << np.uint64(14))
+                | (np.arange(4, dtype=np.uint64)[None, None, :, None] << np.uint64(12))
+                | np.arange(width, dtype=np.uint64)[None, None, None, :])
+    return (splitmix64(counters) >> np.uint64(11)) * (1.0 / 2 ** 53)
+
+
+class BatchGrowth:
+    def __init__(self, seeds, width=30, height=15):
+        require_numpy()
+        self.seeds = np.asarray(seeds, dtype=np.int64)
+        if len(self.seeds) and (self.seeds.min() < 0 or self.seeds.max() >= MAX_SEED):
+            raise ValueError(f"numpy engine seeds must be in [0, {MAX_SEED})")
+        if width > 4096:
+            raise ValueError("numpy engine canvases are at most 4096 columns wide")
+        self.width = width
+        self.height = height
+        self.stage = 0
+        self.row = height - 1
+        # Canvases and palette come from the Python engine, so glyph ids match
+        self.generator = TreeGenerator(width, height, seed=0)
+        canvas = self.generator.new_canvas()
+        # Color index -> first glyph id and number of glyphs of its char type
+        self.glyph_base = np.array([0] + [canvas.glyph_id(self.generator.chars[char_type][0])
+                                          for char_type in ('trunk', 'branch', 'leaves')])
+        self.glyph_count = np.array([1] + [len(self.generator.chars[char_type])
+                                           for char_type in ('trunk', 'branch', 'leaves')])
+
+        count = len(self.seeds)
+        self.glyphs = np.zeros((count, height, width), np.uint16)
+        self.colors = np.zeros((count, height, width), np.uint8)
+        self.life = np.zeros((count, width), np.int16)
+        self.life[:, width // 2] = ROOT_LIFE
+        # Leaf buds drawn over the last grown row, as (row, mask, glyphs)
+        self.buds = None
+
+    def grow(self, stage):
+        while self.stage < stage:
+            self.grow_stage()
+        return self
+
+    def grow_stage(self):
+        self.stage += 1
+        if self.row < 1 or not self.life.any():
+            return
+
+        draws = stage_draws(self.seeds, self.stage, self.width)
+        self.buds = None
+        for step in range(len(draws)):
+            if self.row < 1 or not self.life.any():
+                break
+            placed = self.grow_row(draws[step])
+            self.row -= 1
+
+        # Tips that are still growing are drawn as leaf buds until the next stage
+        alive = self.life.any(axis=1)
+        mask = placed & alive[:, None]
+        if mask.any():
+            leaves = self.glyph_base[3] + (draws[step, :, 3] * self.glyph_count[3]).astype(np.uint16)
+            self.buds = (self.row + 1, mask, leaves)
+
+    def grow_row(self, draws):
+        life = self.life
+        active = life > 0
+        color = np.where(life > 7, 1, np.where(life > 3, 2, 3))
+        glyph = self.glyph_base[color] + (draws[:, 0] * self.glyph_count[color]).astype(np.int64)
+        self.glyphs[:, self.row] = np.where(active, glyph, 0)
+        self.colors[:, self.row] = np.where(active, color, 0)
+
+        # Children go straight up, and on their coin flips up-left and up-right.
+        # Tips landing on the same cell keep the larger life.
+        grows = life > 2
+        next_life = np.where(grows, life - 1, 0)
+        left = np.where(grows & (draws[:, 1] > 0.6), life - 3, 0)
+        right = np.where(grows & (draws[:, 2] > 0.6), life - 3, 0)
+        np.maximum(next_life[:, :-1], left[:, 1:], out=next_life[:, :-1])
+        np.maximum(next_life[:, 1:], right[:, :-1], out=next_life[:, 1:])
+        next_life[:, 0] = 0
+        next_life[:, -1] = 0
+        self.life = next_life.astype(np.int16)
+        return grows
+
+    def canvas(self, index):
+        glyphs = self.glyphs[index]
+        colors = self.colors[index]
+        if self.buds is not None:
+            row, mask, leaves = self.buds
+            glyphs = glyphs.copy()
+            colors = colors.copy()
+            glyphs[row] = np.where(mask[index], leaves[index], glyphs[row])
+            colors[row] = np.where(mask[index], 3, colors[row])
+        canvas = self.generator.new_canvas()
+        canvas.glyphs = array('H', glyphs.tobytes())
+        canvas.colors = bytearray(colors.tobytes())
+        return canvas
+
+    def render(self, fmt='ansi'):
+        return [emit(fmt, self.canvas(index), self.generator.palette) for index in range(len(self.seeds))]
+
+
+def render_batch(seeds, stage, width=30, height=15, fmt='ansi'):
+    return BatchGrowth(seeds, width, height).grow(stage).render(fmt)
@@ -1,8 +1,19 @@
+import argparse
+import os
 import random
+import select
+import struct
 import time
 import sys
+import zlib
+from array import array
 from enum import Enum
-from typing import List, Tuple, Optional, Dict
+from multiprocessing import Pool
+from typing import List, Tuple, Optional
+
+from canvas import Canvas
+from emitters import Color, emit
+from terminal import LiveRenderer
 
 class BranchType(Enum):
     TRUNK = 0
@@ -11,6 +22,38 @@ class BranchType(Enum):
     DYING = 3
     DEAD = 4
 
+# Canvas color index -> Color, index 0 is an empty cell
+PALETTE = [
+    None,
+    Color("bonsai-wood", "\033[33m", "#ccaa44"),
+    Color("bonsai-wood-bright", "\033[1;33m", "#ffdd55"),
+    Color("bonsai-leaf", "\033[32m", "#44cc44"),
+    Color("bonsai-leaf-bright", "\033[1;32m", "#77ff77"),
+    Color("bonsai-dead", "\033[37m", "#aaaaaa"),
+    Color("bonsai-dead-bright", "\033[1;37m", "#ffffff"),
+]
+
+BRANCH_COLORS = {
+    BranchType.TRUNK: [1, 2],
+    BranchType.SHOOT_LEFT: [1, 2],
+    BranchType.SHOOT_RIGHT: [1, 2],
+    BranchType.DYING: [3, 4],
+    BranchType.DEAD: [5, 6]
+}
+
+# Saved trees (Config.save / Config.load) are zlib-compressed: a header with
+# the config and counters, then the Mersenne Twister state, the branch work
+# stack, the canvas glyph table, the leaves and the canvas cells. Loading one
+# picks the tree up exactly where it was saved, nothing is grown again.
+STATE_MAGIC = b"BNSI"
+STATE_VERSION = 1
+DEFAULT_STATE_FILE = "bonsai.dat"
+# magic, version, width, height, seed, life_start, multiplier, base_type,
+# branches, shoots, shoot_counter, stack frames, glyph table and leaves sizes,
+# whether gauss_next is set and its value
+_STATE_HEADER = struct.Struct("<4sBHHqiiiIIIIIIBd")
+_FRAME_SIZE = 8
+
 class Config:
     def __init__(self):
         self.live = False
@@ -43,28 +86,26 @@ class TreeGenerator:
     def __init__(self):
         self.conf = Config()
         self.counters = Counters()
-        self.tree_grid: Dict[Tuple[int, int], str] = {}
+        # Per-instance RNG stream instead of the process-global one
+        self.random = random.Random()
         self.width = 80
         self.height = 24
+        self.canvas = Canvas(self.width, self.height)
+        # Branches still growing, see grow_branches
+        self.stack: List[list] = []
+        self.renderer: Optional[LiveRenderer] = None
 
     def init_config(self):
         if self.conf.seed == 0:
             self.conf.seed = int(time.time())
-        random.seed(self.conf.seed)
+        self.random.seed(self.conf.seed)
 
         if not self.conf.leaves:
             self.conf.leaves = ["&"]
             self.conf.leaves_size = 1
 
-    def choose_color(self, branch_type: BranchType) -> str:
-        colors = {
-            BranchType.TRUNK: ["\033[33m", "\033[1;33m"],
-            BranchType.SHOOT_LEFT: ["\033[33m", "\033[1;33m"],
-            BranchType.SHOOT_RIGHT: ["\033[33m", "\033[1;33m"],
-            BranchType.DYING: ["\033[32m", "\033[1;32m"],
-            BranchType.DEAD: ["\033[37m", "\033[1;37m"]
-        }
-        return random.choice(colors[branch_type])
+    def choose_color(self, branch_type: BranchType) -> int:
+        return self.random.choice(BRANCH_COLORS[branch_type])
 
     def set_deltas(self, branch_type: BranchType, life: int, age: int) -> Tuple[int, int]:
         dx, dy = 0, 0
@@ -73,57 +114,57 @@ class TreeGenerator:
         if branch_type == BranchType.TRUNK:
             if age <= 2 or life < 4:
                 dy = 0
-                dx = random.randint(-1, 1)
+                dx = self.random.randint(-1, 1)
             elif age < (multiplier * 3):
                 if age % int(multiplier * 0.5) == 0:
                     dy = -1
                 else:
                     dy = 0
                 
-                dice = random.randint(0, 9)
+                dice = self.random.randint(0, 9)
                 if dice == 0: dx = -2
                 elif 1 <= dice <= 3: dx = -1
                 elif 4 <= dice <= 5: dx = 0
                 elif 6 <= dice <= 8: dx = 1
                 else: dx = 2
             else:
-                if random.randint(0, 9) > 2:
+                if self.random.randint(0, 9) > 2:
                     dy = -1
                 else:
                     dy = 0
-                dx = random.randint(-1, 1)
+                dx = self.random.randint(-1, 1)
         
         elif branch_type == BranchType.SHOOT_LEFT:
-            dice = random.randint(0, 9)
+            dice = self.random.randint(0, 9)
             if dice <= 1: dy = -1
             elif 2 <= dice <= 7: dy = 0
             else: dy = 1
             
-            dice = random.randint(0, 9)
+            dice = self.random.randint(0, 9)
             if dice <= 1: dx = -2
             elif 2 <= dice <= 5: dx = -1
             elif 6 <= dice <= 8: dx = 0
             else: dx = 1
         
         elif branch_type == BranchType.SHOOT_RIGHT:
-            dice = random.randint(0, 9)
+            dice = self.random.randint(0, 9)
             if dice <= 1: dy = -1
             elif 2 <= dice <= 7: dy = 0
             else: dy = 1
             
-            dice = random.randint(0, 9)
+            dice = self.random.randint(0, 9)
             if dice <= 1: dx = 2
             elif 2 <= dice <= 5: dx = 1
             elif 6 <= dice <= 8: dx = 0
             else: dx = -1
         
         elif branch_type == BranchType.DYING:
-            dice = random.randint(0, 9)
+            dice = self.random.randint(0, 9)
             if dice <= 1: dy = -1
             elif 2 <= dice <= 8: dy = 0
             else: dy = 1
             
-            dice = random.randint(0, 14)
+            dice = self.random.randint(0, 14)
             if dice == 0: dx = -3
             elif 1 <= dice <= 2: dx = -2
             elif 3 <= dice <= 5: dx = -1
@@ -133,11 +174,11 @@ class TreeGenerator:
             else: dx = 3
         
         else:  # DEAD
-            dice = random.randint(0, 9)
+            dice = self.random.randint(0, 9)
             if dice <= 2: dy = -1
             elif 3 <= dice <= 6: dy = 0
             else: dy = 1
-            dx = random.randint(-1, 1)
+            dx = self.random.randint(-1, 1)
         
         return dx, dy
 
@@ -166,43 +207,73 @@ class TreeGenerator:
             elif dx > 0: return "/"
         
         else:  # DYING or DEAD
-            return random.choice(self.conf.leaves)
+            return self.random.choice(self.conf.leaves)
 
     def branch(self, y: int, x: int, branch_type: BranchType, life: int):
         self.counters.branches += 1
-        dx, dy = 0, 0
-        age = 0
-        shoot_cooldown = self.conf.multiplier
+        self.stack.append([y, x, branch_type, life, self.conf.multiplier, 0, 0, False])
+        self.grow_branches()
+
+    def grow_branches(self):
+        # Explicit work stack instead of recursion: a spawned branch is pushed on top of
+        # its parent and grown to completion before the parent resumes its step, so the
+        # RNG is consumed in the same order as the recursive version. The stack lives on
+        # the generator, so a saved tree can go on growing after it's loaded.
+        # Frame: [y, x, branch_type, life, shoot_cooldown, dx, dy, waiting_for_child]
+        multiplier = self.conf.multiplier
+        life_start = self.conf.life_start
+        randint = self.random.randint
+        set_deltas = self.set_deltas
+        choose_string = self.choose_string
+        choose_color = self.choose_color
+        put = self.canvas.put
+        counters = self.counters
+        stack = self.stack
         
-        while life > 0:
-            life -= 1
-            age = self.conf.life_start - life
-            
-            dx, dy = self.set_deltas(branch_type, life, age)
+        while stack:
+            frame = stack[-1]
+            y, x, branch_type, life, shoot_cooldown, dx, dy, waiting = frame
             
-            # Near-dead branch should branch into a lot of leaves
-            if life < 3:
-                self.branch(y, x, BranchType.DEAD, life)
-            # Dying trunk should branch into a lot of leaves
-            elif branch_type == BranchType.TRUNK and life < (self.conf.multiplier + 2):
-                self.branch(y, x, BranchType.DYING, life)
-            # Dying shoot should branch into a lot of leaves
-            elif branch_type in [BranchType.SHOOT_LEFT, BranchType.SHOOT_RIGHT] and life < (self.conf.multiplier + 2):
-                self.branch(y, x, BranchType.DYING, life)
-            # Trunks should re-branch
-            elif branch_type == BranchType.TRUNK and (random.randint(0, 2) == 0 or life % self.conf.multiplier == 0):
-                if random.randint(0, 7) == 0 and life > 7:
-                    shoot_cooldown = self.conf.multiplier * 2
-                    self.branch(y, x, BranchType.TRUNK, life + random.randint(-2, 2))
-                elif shoot_cooldown <= 0:
-                    shoot_cooldown = self.conf.multiplier * 2
-                    shoot_life = life + self.conf.multiplier
-                    self.counters.shoots += 1
-                    self.counters.shoot_counter += 1
-                    
-                    # Create shoot (alternate between left and right)
-                    shoot_type = BranchType.SHOOT_LEFT if self.counters.shoot_counter % 2 else BranchType.SHOOT_RIGHT
-                    self.branch(y, x, shoot_type, shoot_life)
+            if not waiting:
+                if life <= 0:
+                    stack.pop()
+                    continue
+                
+                life -= 1
+                age = life_start - life
+                
+                dx, dy = set_deltas(branch_type, life, age)
+                
+                child_type, child_life = None, 0
+                # Near-dead branch should branch into a lot of leaves
+                if life < 3:
+                    child_type, child_life = BranchType.DEAD, life
+                # Dying trunk should branch into a lot of leaves
+                elif branch_type == BranchType.TRUNK and life < (multiplier + 2):
+                    child_type, child_life = BranchType.DYING, life
+                # Dying shoot should branch into a lot of leaves
+                elif branch_type in [BranchType.SHOOT_LEFT, BranchType.SHOOT_RIGHT] and life < (multiplier + 2):
+                    child_type, child_life = BranchType.DYING, life
+                # Trunks should re-branch
+                elif branch_type == BranchType.TRUNK and (randint(0, 2) == 0 or life % multiplier == 0):
+                    if randint(0, 7) == 0 and life > 7:
+                        shoot_cooldown = multiplier * 2
+                        child_type, child_life = BranchType.TRUNK, life + randint(-2, 2)
+                    elif shoot_cooldown <= 0:
+                        shoot_cooldown = multiplier * 2
+                        counters.shoots += 1
+                        counters.shoot_counter += 1
+                        
+                        # Create shoot (alternate between left and right)
+                        child_type = BranchType.SHOOT_LEFT if counters.shoot_counter % 2 else BranchType.SHOOT_RIGHT
+                        child_life = life + multiplier
+                
+                if child_type is not None:
+                    # Suspend this branch until the child has finished growing
+                    frame[3:] = [life, shoot_cooldown, dx, dy, True]
+                    counters.branches += 1
+                    stack.append([y, x, child_type, child_life, multiplier, 0, 0, False])
+                    continue
             
             shoot_cooldown -= 1
             
@@ -211,50 +282,137 @@ class TreeGenerator:
             y += dy
             
             # Choose string to use for this branch
-            branch_str = self.choose_string(branch_type, life, dx, dy)
+            branch_str = choose_string(branch_type, life, dx, dy)
             
-            # Store in grid
-            self.tree_grid[(x, y)] = f"{self.choose_color(branch_type)}{branch_str}\033[0m"
+            # Store on the canvas
+            put(x, y, branch_str, choose_color(branch_type))
             
-            if self.conf.live and not (self.conf.load and self.counters.branches < self.conf.target_branch_count):
-                self.print_tree()
-                time.sleep(self.conf.time_step)
+            frame[:] = [y, x, branch_type, life, shoot_cooldown, dx, dy, False]
+            
+            if self.conf.live and not (self.conf.load and counters.branches < self.conf.target_branch_count):
+                self.renderer.frame(self.canvas)
+
+    def render(self, fmt: str) -> str:
+        return emit(fmt, self.canvas, PALETTE)
 
     def print_tree(self):
-        # Clear screen
+        # Clear screen and print the whole canvas in one go
         print("\033[2J\033[H", end="")
-        
-        # Print each character in the grid
-        for y in range(self.height):
-            for x in range(self.width):
-                if (x, y) in self.tree_grid:
-                    print(self.tree_grid[(x, y)], end="")
-                else:
-                    print(" ", end="")
-            print()
+        print(self.render("ansi"))
+
+    def grow(self, resume: bool = False):
+        if not resume:
+            # Reset counters and canvas
+            self.counters = Counters()
+            self.canvas = Canvas(self.width, self.height)
+            self.stack = []
+        if self.conf.live:
+            # Live growth only sends the cells that changed between frames
+            self.renderer = LiveRenderer(PALETTE, self.conf.time_step)
+
+        if resume:
+            # A loaded tree goes on from its saved work stack
+            self.grow_branches()
+            return
 
-    def grow_tree(self):
-        # Reset counters and grid
-        self.counters = Counters()
-        self.tree_grid = {}
-        
         # Start growing from bottom center
         start_y = self.height - 1
         start_x = self.width // 2
         
-        # Recursively grow tree trunk and branches
+        # Grow tree trunk and branches
         self.branch(start_y, start_x, BranchType.TRUNK, self.conf.life_start)
+
+    def grow_tree(self, resume: bool = False):
+        self.grow(resume)
         
         # Final print
-        if not self.conf.live:
+        if self.conf.live:
+            self.renderer.finish(self.canvas)
+        else:
             self.print_tree()
 
+    def to_bytes(self) -> bytes:
+        conf, counters, canvas = self.conf, self.counters, self.canvas
+        _, internal, gauss_next = self.random.getstate()
+        glyph_table = "\0".join(canvas.glyph_table[1:]).encode()
+        leaves = "\0".join(conf.leaves).encode()
+        header = _STATE_HEADER.pack(
+            STATE_MAGIC, STATE_VERSION, canvas.width, canvas.height, conf.seed, conf.life_start,
+            conf.multiplier, conf.base_type, counters.branches, counters.shoots, counters.shoot_counter,
+            len(self.stack), len(glyph_table), len(leaves), gauss_next is not None, gauss_next or 0.0)
+        frames = array("i")
+        for y, x, branch_type, life, shoot_cooldown, dx, dy, waiting in self.stack:
+            frames.extend((y, x, branch_type.value, life, shoot_cooldown, dx, dy, waiting))
+        return zlib.compress(header + array("I", internal).tobytes() + frames.tobytes() + glyph_table
+                             + leaves + canvas.glyphs.tobytes() + bytes(canvas.colors))
+
+    def restore(self, data: bytes):
+        # Replaces the tree, its config and the RNG with a saved one. Display
+        # settings (live, time_step, ...) stay as they are.
+        data = zlib.decompress(data)
+        (magic, version, width, height, seed, life_start, multiplier, base_type, branches, shoots,
+         shoot_counter, frame_count, table_size, leaves_size, has_gauss,
+         gauss_next) = _STATE_HEADER.unpack_from(data)
+        if magic != STATE_MAGIC or version != STATE_VERSION:
+            raise ValueError("Not a saved tree of this version")
+
+        offset = _STATE_HEADER.size
+        internal = array("I", data[offset:offset + 4 * 625])
+        offset += 4 * 625
+        frames = array("i", data[offset:offset + 4 * _FRAME_SIZE * frame_count])
+        offset += 4 * _FRAME_SIZE * frame_count
+        glyph_table = data[offset:offset + table_size].decode()
+        offset += table_size
+        leaves = data[offset:offset + leaves_size].decode()
+        offset += leaves_size
+
+        canvas = Canvas(width, height)
+        for glyph in glyph_table.split("\0") if glyph_table else []:
+            canvas.glyph_id(glyph)
+        canvas.glyphs = array("H", data[offset:offset + 2 * width * height])
+        offset += 2 * width * height
+        canvas.colors = bytearray(data[offset:offset + width * height])
+
+        conf = self.conf
+        conf.seed, conf.life_start, conf.multiplier, conf.base_type = seed, life_start, multiplier, base_type
+        conf.leaves = leaves.split("\0")
+        conf.leaves_size = len(conf.leaves)
+        # Everything up to here is already grown, no frames to skip
+        conf.target_branch_count = branches
+        self.counters = Counters()
+        self.counters.branches, self.counters.shoots, self.counters.shoot_counter = branches, shoots, shoot_counter
+        self.width, self.height, self.canvas = width, height, canvas
+        self.stack = [[y, x, BranchType(branch_type), life, shoot_cooldown, dx, dy, bool(waiting)]
+                      for y, x, branch_type, life, shoot_cooldown, dx, dy, waiting
+                      in zip(*[iter(frames)] * _FRAME_SIZE)]
+        self.random.setstate((3, tuple(internal), gauss_next if has_gauss else None))
+
+    def save_state(self, path: str):
+        # Written aside and renamed, so an interrupted save keeps the old file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as out:
+            out.write(self.to_bytes())
+        os.replace(tmp_path, path)
+
+    def load_state(self, path: str):
+        with open(path, "rb") as source:
+            self.restore(source.read())
+
     def run(self):
-        self.init_config()
+        # With conf.load the saved tree is picked up where it was left, with
+        # conf.save the tree is saved when it's done or interrupted
+        resume = self.conf.load
+        if resume:
+            self.load_state(self.conf.load_file or DEFAULT_STATE_FILE)
+        else:
+            self.init_config()
         
         try:
             while True:
-                self.grow_tree()
+                self.grow_tree(resume)
+                resume = False
+                if self.conf.save:
+                    self.save_state(self.conf.save_file or DEFAULT_STATE_FILE)
                 
                 if not self.conf.infinite:
                     break
@@ -265,18 +423,141 @@ class TreeGenerator:
                 time.sleep(self.conf.time_wait)
                 
                 # Reseed for next tree
-                random.seed(int(time.time()))
+                self.random.seed(int(time.time()))
                 
         except KeyboardInterrupt:
-            pass
+            if self.conf.save:
+                self.save_state(self.conf.save_file or DEFAULT_STATE_FILE)
+
+BATCH_FORMATS = ("ansi", "html", "json")
+BATCH_CHUNK = 64
+
+
+def render_seeds(first: int, stop: int, fmt: str, life_start: int, multiplier: int,
+                 leaves: List[str]) -> List[str]:
+    # Every tree gets a fresh generator seeded with its own seed, so the output
+    # doesn't depend on how seeds are split between workers
+    trees = []
+    for seed in range(first, stop):
+        generator = TreeGenerator()
+        generator.conf.seed = seed
+        generator.conf.life_start = life_start
+        generator.conf.multiplier = multiplier
+        generator.conf.leaves = leaves
+        generator.conf.leaves_size = len(leaves)
+        generator.init_config()
+        generator.grow()
+        tree = generator.render(fmt)
+        if fmt == "ansi":
+            trees.append(f"seed {seed}\n{tree}\n\n")
+        elif fmt == "html":
+            trees.append(f'<pre class="bonsai" data-seed="{seed}">{tree}</pre>\n')
+        else:
+            # JSON Lines, one tree per line
+            trees.append(f'{{"seed":{seed},"tree":{tree}}}\n')
+    return trees
+
+
+def _render_job(job):
+    return render_seeds(*job)
+
+
+def render_batch(out, first: int, count: int, fmt: str = "ansi", life_start: int = 32,
+                 multiplier: int = 5, leaves: Optional[List[str]] = None,
+                 workers: Optional[int] = None) -> int:
+    # Trees for seeds first .. first + count - 1 in seed order, written to out as
+    # they come back from the workers. workers=1 renders in this process.
+    # Returns the number of trees written.
+    leaves = leaves or ["&"]
+    jobs = ((start, min(start + BATCH_CHUNK, first + count), fmt, life_start, multiplier, leaves)
+            for start in range(first, first + count, BATCH_CHUNK))
+    if fmt == "html":
+        out.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><style>'
+                  "body{background:#000}.bonsai{font-family:monospace;line-height:1.2}"
+                  + "".join(f".{color.name}{{color:{color.rgb}}}" for color in PALETTE if color)
+                  + "</style></head><body>\n")
+
+    written = 0
+    pool = Pool(workers) if workers != 1 else None
+    try:
+        for trees in pool.imap(_render_job, jobs) if pool else map(_render_job, jobs):
+            out.writelines(trees)
+            written += len(trees)
+    finally:
+        if pool:
+            pool.terminate()
+
+    if fmt == "html":
+        out.write("</body></html>\n")
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Grow a bonsai live in the terminal, or with --count a batch of trees for a range of seeds")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="first seed of a batch (default 1), or the seed of the live tree (default: time)")
+    parser.add_argument("--count", type=int,
+                        help="number of trees to generate, for seeds --seed .. --seed + count - 1")
+    parser.add_argument("--format", choices=BATCH_FORMATS, default="ansi")
+    parser.add_argument("--output", default="-", help="file to write the batch to, - for stdout")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--life-start", type=int, default=32)
+    parser.add_argument("--multiplier", type=int, default=5)
+    parser.add_argument("--leaves", default="@#*%&", help="characters used for leaves")
+    parser.add_argument("--infinite", action="store_true", help="keep growing new live trees")
+    parser.add_argument("--screensaver", action="store_true", help="like --infinite, until a key is pressed")
+    parser.add_argument("--save", nargs="?", const=DEFAULT_STATE_FILE, metavar="FILE",
+                        help=f"save the live tree when it's done or interrupted (default {DEFAULT_STATE_FILE})")
+    parser.add_argument("--load", nargs="?", const=DEFAULT_STATE_FILE, metavar="FILE",
+                        help="go on growing a saved tree")
+    args = parser.parse_args()
+    leaves = list(args.leaves) or ["&"]
+
+    if args.count is None:
+        generator = TreeGenerator()
+        generator.conf.live = True
+        generator.conf.infinite = args.infinite or args.screensaver
+        generator.conf.screensaver = args.screensaver
+        generator.conf.seed = args.seed
+        generator.conf.life_start = args.life_start
+        generator.conf.multiplier = args.multiplier
+        generator.conf.leaves = leaves
+        generator.conf.leaves_size = len(leaves)
+        generator.conf.save = args.save is not None
+        generator.conf.save_file = args.save or ""
+        generator.conf.load = args.load is not None
+        generator.conf.load_file = args.load or ""
+        generator.run()
+        return
+
+    if args.save or args.load:
+        parser.error("--save and --load only apply to the live tree")
+    if args.count < 1 or args.workers < 1:
+        parser.error("--count and --workers must be positive")
+    first = args.seed or 1
+    if first < 1:
+        parser.error("batch seeds must be positive, seed 0 means the current time")
+
+    start = time.perf_counter()
+    if args.output == "-":
+        try:
+            trees = render_batch(sys.stdout, first, args.count, args.format, args.life_start,
+                                 args.multiplier, leaves, args.workers)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # The reader is gone (e.g. piped into head), stop quietly
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            sys.exit(1)
+    else:
+        with open(args.output, "w", encoding="utf-8") as out:
+            trees = render_batch(out, first, args.count, args.format, args.life_start,
+                                 args.multiplier, leaves, args.workers)
+    elapsed = time.perf_counter() - start
+    # On stderr, so it stays out of a batch written to stdout
+    print(f"{trees} trees in {elapsed:.2f} s ({trees / elapsed:.0f} trees/s, workers={args.workers})",
+          file=sys.stderr)
+
 
 if __name__ == "__main__":
-    generator = TreeGenerator()
-    
-    # Example configuration
-    generator.conf.live = True
-    generator.conf.infinite = False
-    generator.conf.leaves = ["@", "#", "*", "%", "&"]
-    generator.conf.leaves_size = len(generator.conf.leaves)
-    
-    generator.run()
\ No newline at end of file
+    main()
@@ -0,0 +1,163 @@
+import threading
+import time
+
+from sqlalchemy import insert, select, update, func, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import SQLAlchemyError
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, every process compacts there
+    fcntl = None
+
+from extensions import db
+from models import WateringEvent, RollupState
+
+# Every watering is appended to watering_event. A background compactor adds new
+# events to hourly and daily per-plant and per-user buckets in watering_rollup,
+# so a chart over months reads a few hundred bucket rows. Events newer than the
+# last compaction are read raw, so series are always up to date.
+
+HOUR = 3600
+DAY = 24 * HOUR
+RESOLUTIONS = (HOUR, DAY)
+COMPACTOR = 'watering'
+COMPACT_BATCH = 50000
+
+ROLLUP_SQL = (
+    'INSERT INTO watering_rollup (user_id, plant_id, resolution, bucket, waterings, levels) '
+    'SELECT user_id, {plant}, :resolution, ts / :resolution * :resolution, sum(waterings), sum(levels) '
+    'FROM watering_event WHERE id > :low AND id <= :high '
+    'GROUP BY user_id, {group}ts / :resolution '
+    'ON CONFLICT (user_id, plant_id, resolution, bucket) DO UPDATE SET '
+    'waterings = waterings + excluded.waterings, levels = levels + excluded.levels'
+)
+SERIES_SQL = text(
+    'WITH mark AS (SELECT coalesce((SELECT last_event_id FROM rollup_state WHERE name = :compactor), 0) AS id) '
+    'SELECT t / :step * :step AS t, sum(waterings), sum(levels) FROM ('
+    'SELECT bucket AS t, waterings, levels FROM watering_rollup '
+    'WHERE user_id = :user_id AND plant_id = :plant_id AND resolution = :resolution '
+    'AND bucket >= :start AND bucket <= :end '
+    'UNION ALL '
+    'SELECT ts, waterings, levels FROM watering_event, mark '
+    'WHERE watering_event.id > mark.id AND user_id = :user_id AND (:plant_id = 0 OR plant_id = :plant_id) '
+    'AND ts >= :start AND ts <= :end'
+    ') GROUP BY 1 ORDER BY 1'
+)
+PLANT_ROLLUP = text(ROLLUP_SQL.format(plant='plant_id', group='plant_id, '))
+USER_ROLLUP = text(ROLLUP_SQL.format(plant='0', group=''))
+
+
+def record(history):
+    # One multi-row insert for all waterings of a request, in its transaction
+    if history:
+        db.session.execute(insert(WateringEvent), history)
+
+
+def last_compacted():
+    state = db.session.get(RollupState, COMPACTOR)
+    return state.last_event_id if state else 0
+
+
+def compact():
+    # Rolls up the next batch of events, returns how many were rolled up.
+    # The watermark is read outside a transaction, so another compactor may
+    # have moved it by the time the rollup is written. The rollup therefore
+    # only commits if the watermark is still where it was read, checked after
+    # the rollup writes have taken SQLite's write lock.
+    low = last_compacted()
+    high = db.session.execute(select(func.max(WateringEvent.id))).scalar() or 0
+    high = min(high, low + COMPACT_BATCH)
+    if high <= low:
+        db.session.rollback()
+        return 0
+
+    for resolution in RESOLUTIONS:
+        params = {'resolution': resolution, 'low': low, 'high': high}
+        db.session.execute(PLANT_ROLLUP, params)
+        db.session.execute(USER_ROLLUP, params)
+    db.session.execute(sqlite_insert(RollupState).values(name=COMPACTOR, last_event_id=0)
+                       .on_conflict_do_nothing())
+    moved = db.session.execute(
+        update(RollupState)
+        .where(RollupState.name == COMPACTOR, RollupState.last_event_id == low)
+        .values(last_event_id=high)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not moved:
+        # Another compactor got there first, its rollup already has these events
+        db.session.rollback()
+        return 0
+    db.session.commit()
+    return high - low
+
+
+def prune(retention):
+    # Raw events already in the rollups are only kept for a while
+    result = db.session.execute(
+        WateringEvent.__table__.delete()
+        .where(WateringEvent.id <= last_compacted(), WateringEvent.ts < int(time.time()) - retention)
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def compactor_lock(path):
+    # Non-blocking exclusive lock on a file next to the database, held until
+    # the process exits. Returns None when another process holds it.
+    if fcntl is None:
+        return True
+    lock = open(path, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+
+def start_compactor(app, interval, retention=None):
+    # Every process of the app starts one, only the one holding the database's
+    # compactor lock does the work. The others keep trying, in case it exits.
+    with app.app_context():
+        database = db.engine.url.database
+    lock_path = f'{database}-compactor.lock' if database and database != ':memory:' else None
+
+    def run():
+        lock = None if lock_path else True
+        while True:
+            time.sleep(interval)
+            if lock is None:
+                lock = compactor_lock(lock_path)
+                if lock is None:
+                    continue
+            with app.app_context():
+                try:
+                    while compact():
+                        pass
+                    if retention is not None:
+                        prune(retention)
+                except SQLAlchemyError as error:
+                    db.session.rollback()
+                    app.logger.warning('Watering compaction failed: %s', error)
+
+    thread = threading.Thread(target=run, name='watering-compactor', daemon=True)
+    thread.start()
+    return thread
+
+
+def series(user_id, plant_id, start, end, points):
+    # Waterings and levels gained from start through end (Unix seconds) in at
+    # most about `points` buckets, as [bucket start, waterings, levels].
+    # plant_id 0 means all of the user's plants.
+    step = max((end - start) // max(points, 1), 1)
+    resolution = DAY if step >= DAY else HOUR
+    step = -(-step // resolution) * resolution
+    # Rollups and the events the compactor hasn't got to yet, with the
+    # watermark between them read in the same statement, so a compaction
+    # committing meanwhile can't have an event counted on both sides
+    rows = db.session.execute(SERIES_SQL, {
+        'compactor': COMPACTOR, 'step': step, 'user_id': user_id, 'plant_id': plant_id,
+        'resolution': resolution, 'start': start // resolution * resolution, 'end': end,
+    })
+    return resolution, step, [list(row) for row in rows]
@@ -0,0 +1,39 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Worker processes for CPU-bound calls (password hashing, tree renders). They
+# are started with forkserver, or spawn where there is no forkserver, never by
+# forking the web process: by the time a pool starts, that process has threads
+# and open database connections that a forked child would inherit half-way.
+# Workers import the main module, so it must be safe to import (see app.py).
+
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+class WorkerPool:
+    # A process pool started on first use, so importing the app starts no
+    # processes. workers=0 runs every call in the calling thread, None means
+    # one worker per core.
+    def __init__(self, workers=None, start_method=START_METHOD):
+        self.workers = workers
+        self.context = multiprocessing.get_context(start_method)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=self.context)
+            return self._pool
+
+    def run(self, fn, *args):
+        if self.workers == 0:
+            return fn(*args)
+        return self._executor().submit(fn, *args).result()
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None